@@ -0,0 +1,3083 @@
+import cv2
+import numpy as np
+try:
+    from picamera2 import Picamera2
+except ImportError:
+    Picamera2 = None  # Only the picamera frame source needs it
+import time
+import os
+import sys
+import threading
+import asyncio
+import collections
+import contextlib
+import json
+import functools
+import zlib
+import importlib
+import types
+import platform
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+from multiprocessing import shared_memory
+
+class TemplateTracker:
+    # The cheapest backend: normalized cross-correlation of the initial patch
+    # inside a small search window around the last position
+    def __init__(self, search_margin=16, min_score=0.5):
+        self.search_margin = search_margin
+        self.min_score = min_score
+        self.template = None
+        self.bbox = None
+
+    def init(self, frame, bbox):
+        x, y, w, h = (int(v) for v in bbox)
+        self.template = to_gray(frame)[y:y + h, x:x + w].copy()
+        self.bbox = (x, y, w, h)
+
+    def update(self, frame):
+        gray = to_gray(frame)
+        x, y, w, h = self.bbox
+        x0, y0 = max(x - self.search_margin, 0), max(y - self.search_margin, 0)
+        x1 = min(x + w + self.search_margin, gray.shape[1])
+        y1 = min(y + h + self.search_margin, gray.shape[0])
+        window = gray[y0:y1, x0:x1]
+        if window.shape[0] < h or window.shape[1] < w:
+            return False, self.bbox
+        scores = cv2.matchTemplate(window, self.template, cv2.TM_CCOEFF_NORMED)
+        _, score, _, (best_x, best_y) = cv2.minMaxLoc(scores)
+        if score < self.min_score:
+            return False, self.bbox
+        self.bbox = (x0 + best_x, y0 + best_y, w, h)
+        return True, self.bbox
+
+def create_legacy_mosse():
+    return cv2.legacy.TrackerMOSSE_create()
+
+# Tracker backends from most to least accurate. Cost mostly falls in the same
+# order, but TrackerBudgetPolicy goes by the measured cost of each. CSRT and
+# KCF only exist in contrib builds, MOSSE only under cv2.legacy there; the
+# template tracker works everywhere.
+TRACKER_BACKENDS = {
+    'csrt': getattr(cv2, 'TrackerCSRT_create', None),
+    'kcf': getattr(cv2, 'TrackerKCF_create', None),
+    'mosse': create_legacy_mosse,
+    'template': TemplateTracker,
+}
+if not hasattr(cv2, 'legacy') or not hasattr(cv2.legacy, 'TrackerMOSSE_create'):
+    del TRACKER_BACKENDS['mosse']
+TRACKER_BACKENDS = {name: create for name, create in TRACKER_BACKENDS.items() if create is not None}
+BACKEND_LADDER = list(TRACKER_BACKENDS)
+# What new tracks start on
+DEFAULT_BACKEND = 'kcf' if 'kcf' in TRACKER_BACKENDS else 'template'
+
+def create_tracker(backend):
+    return TRACKER_BACKENDS[backend]()
+
+class TrackerBudgetPolicy:
+    # Moves one track at a time to a cheaper backend while tracking takes
+    # longer than frame_budget seconds, and one step back up the accuracy
+    # ladder when it would still take less than headroom * frame_budget after
+    # the switch, going by measured costs. cooldown frames between changes
+    # stop it from flapping on noisy timings.
+    def __init__(self, frame_budget=0.012, headroom=0.5, cooldown=15):
+        self.frame_budget = frame_budget
+        self.headroom = headroom
+        self.cooldown = cooldown
+        self.frames_since_change = 0
+        self.switches = 0
+
+    def cheaper_backend(self, backend, backend_costs):
+        # The next less accurate backend that is actually cheaper, judging by
+        # measured average cost; unmeasured backends get the benefit of the doubt
+        current = backend_costs.get(backend)
+        for candidate in BACKEND_LADDER[BACKEND_LADDER.index(backend) + 1:]:
+            cost = backend_costs.get(candidate)
+            if cost is None or current is None or cost < current:
+                return candidate
+        return None
+
+    def choose_switch(self, objects, elapsed, backend_costs):
+        # Returns (object, new backend) or None
+        self.frames_since_change += 1
+        if not objects or self.frames_since_change < self.cooldown:
+            return None
+        switch = None
+        if elapsed > self.frame_budget:
+            for obj in sorted(objects, key=lambda obj: obj.get('last_cost', 0.0), reverse=True):
+                backend = self.cheaper_backend(obj['backend'], backend_costs)
+                if backend is not None:
+                    switch = (obj, backend)
+                    break
+        elif elapsed < self.frame_budget * self.headroom:
+            candidates = [obj for obj in objects if BACKEND_LADDER.index(obj['backend']) > 0]
+            for obj in sorted(candidates, key=lambda obj: BACKEND_LADDER.index(obj['backend']), reverse=True):
+                backend = BACKEND_LADDER[BACKEND_LADDER.index(obj['backend']) - 1]
+                # An unmeasured backend is tried once to learn its cost
+                cost = backend_costs.get(backend)
+                current = backend_costs.get(obj['backend'], obj.get('last_cost', 0.0))
+                if cost is None or elapsed + cost - current < self.frame_budget * self.headroom:
+                    switch = (obj, backend)
+                    break
+        if switch is not None:
+            self.frames_since_change = 0
+            self.switches += 1
+        return switch
+
+def timed_update(tracker, frame):
+    start = time.perf_counter()
+    success, bbox = tracker.update(frame)
+    return success, bbox, time.perf_counter() - start
+
+def tracking_shard_worker(connection, frame_name, frame_shape, results_name, max_objects):
+    # Owns the KCF trackers for one shard of object ids. Frames are read from
+    # shared memory and bboxes written back into one row per slot, so only
+    # tiny command tuples ever cross the pipe.
+    frame_memory = shared_memory.SharedMemory(name=frame_name)
+    results_memory = shared_memory.SharedMemory(name=results_name)
+    frame = np.ndarray(frame_shape, np.uint8, buffer=frame_memory.buf)
+    results = np.ndarray((max_objects, 6), np.float32, buffer=results_memory.buf)
+    trackers = {}
+    try:
+        while True:
+            command, slot, bbox, backend = connection.recv()
+            if command == 'update':
+                # slot is the list of slots to update; the motion filter may
+                # have skipped the rest this frame
+                for tracker_slot in slot:
+                    success, box, seconds = timed_update(trackers[tracker_slot], frame)
+                    results[tracker_slot] = (success,) + tuple(box) + (seconds,)
+                connection.send(True)
+            elif command == 'init':
+                # A failed init keeps the slot's old tracker and sends back
+                # the error for the caller to raise
+                try:
+                    tracker = create_tracker(backend)
+                    tracker.init(frame, bbox)
+                except cv2.error as e:
+                    connection.send(str(e))
+                    continue
+                trackers[slot] = tracker
+                results[slot] = (1,) + tuple(bbox) + (0.0,)
+                connection.send(True)
+            elif command == 'remove':
+                trackers.pop(slot, None)
+            elif command == 'stop':
+                break
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        del frame, results
+        frame_memory.close()
+        results_memory.close()
+
+class ShardedTracking:
+    # Tracker shards in worker processes. Each frame is copied into shared
+    # memory once and every shard updates its own objects from it in parallel;
+    # bboxes come back through a shared (max_objects, 6) float array of
+    # success, x, y, w, h and update seconds.
+    def __init__(self, workers, frame_shape, max_objects=128):
+        self.frame_shape = tuple(frame_shape)
+        self.frame_memory = shared_memory.SharedMemory(create=True, size=int(np.prod(frame_shape)))
+        self.results_memory = shared_memory.SharedMemory(create=True, size=max_objects * 6 * 4)
+        self.frame = np.ndarray(frame_shape, np.uint8, buffer=self.frame_memory.buf)
+        self.results = np.ndarray((max_objects, 6), np.float32, buffer=self.results_memory.buf)
+        self.slots = {}  # object id -> (shard, slot)
+        self.free_slots = list(range(max_objects))
+        self.lock = threading.Lock()
+        self.connections = []
+        self.processes = []
+        # Spawn rather than fork: the capture and processing threads are running
+        context = multiprocessing.get_context('spawn')
+        try:
+            for _ in range(workers):
+                connection, child_connection = context.Pipe()
+                process = context.Process(
+                    target=tracking_shard_worker,
+                    args=(child_connection, self.frame_memory.name, self.frame_shape, self.results_memory.name, max_objects))
+                process.daemon = True
+                process.start()
+                self.connections.append(connection)
+                self.processes.append(process)
+        except Exception:
+            self.close()
+            raise
+
+    def publish(self, frame):
+        if frame.shape != self.frame_shape:
+            raise ValueError(f"frame shape {frame.shape} does not match shared frame {self.frame_shape}")
+        np.copyto(self.frame, frame)
+
+    def init_object(self, object_id, frame, bbox, backend=DEFAULT_BACKEND):
+        # Re-initializing an object keeps its slot, e.g. to switch backends
+        with self.lock:
+            self.publish(frame)
+            new = object_id not in self.slots
+            if not new:
+                shard, slot = self.slots[object_id]
+            else:
+                if not self.free_slots:
+                    raise IndexError(f"all {len(self.results)} shard result slots are in use")
+                shard = object_id % len(self.connections)
+                slot = self.free_slots.pop(0)
+                self.slots[object_id] = (shard, slot)
+            self.connections[shard].send(('init', slot, tuple(int(v) for v in bbox), backend))
+            reply = self.connections[shard].recv()
+            if reply is not True:
+                if new:
+                    del self.slots[object_id]
+                    self.free_slots.append(slot)
+                raise cv2.error(reply)
+
+    def remove_object(self, object_id):
+        with self.lock:
+            if object_id not in self.slots:
+                return
+            shard, slot = self.slots.pop(object_id)
+            self.connections[shard].send(('remove', slot, None, None))
+            self.free_slots.append(slot)
+
+    def update(self, frame, object_ids):
+        with self.lock:
+            self.publish(frame)
+            shards = {}
+            for object_id in object_ids:
+                shard, slot = self.slots[object_id]
+                shards.setdefault(shard, []).append(slot)
+            for shard, slots in shards.items():
+                self.connections[shard].send(('update', slots, None, None))
+            for shard in shards:
+                self.connections[shard].recv()
+            results = []
+            for object_id in object_ids:
+                success, x, y, w, h, seconds = self.results[self.slots[object_id][1]]
+                results.append((bool(success), (int(x), int(y), int(w), int(h)), float(seconds)))
+            return results
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send(('stop', None, None, None))
+            except (OSError, ValueError):
+                pass
+        for process in self.processes:
+            process.join(timeout=1.0)
+            if process.is_alive():
+                process.terminate()
+        del self.frame, self.results
+        for memory in (self.frame_memory, self.results_memory):
+            memory.close()
+            memory.unlink()
+
+def bbox_center(bbox):
+    x, y, w, h = bbox
+    return (x + w / 2, y + h / 2)
+
+def frame_patch(frame, bbox):
+    x, y, w, h = (int(v) for v in bbox)
+    x, y = max(x, 0), max(y, 0)
+    return frame[y:y + max(h, 1), x:x + max(w, 1)]
+
+class ConstantVelocityFilter:
+    # Batched constant-velocity Kalman filter over track centers. Each tracker
+    # slot has a (cx, cy, vx, vy) state in tracking-frame pixels and a 4x4
+    # covariance; the whole set is predicted and corrected with one matmul.
+    # A track's tracker only runs when the filter thinks the mini is moving
+    # (speed or last innovation above threshold) or the pixels under it have
+    # changed since its last update, so an idle table costs one small absdiff
+    # per mini instead of one tracker update.
+    def __init__(self, process_noise=0.5, measurement_noise=4.0, min_speed=0.3, innovation_threshold=2.0, change_threshold=6.0, refresh_interval=30):
+        self.transition = np.array([[1, 0, 1, 0], [0, 1, 0, 1], [0, 0, 1, 0], [0, 0, 0, 1]], float)
+        self.process_noise = process_noise * np.diag([0.25, 0.25, 1.0, 1.0])
+        self.measurement_noise = measurement_noise * np.eye(2)
+        self.min_speed = min_speed
+        self.innovation_threshold = innovation_threshold
+        self.change_threshold = change_threshold
+        self.refresh_interval = refresh_interval
+        self.updates = 0
+        self.skipped = 0
+
+    def initial_state(self, bbox):
+        cx, cy = bbox_center(bbox)
+        covariance = np.diag([self.measurement_noise[0, 0], self.measurement_noise[1, 1], 100.0, 100.0])
+        return np.array([cx, cy, 0.0, 0.0]), covariance
+
+    def predict(self, states, covariances):
+        states[:] = states @ self.transition.T
+        covariances[:] = self.transition @ covariances @ self.transition.T + self.process_noise
+
+    def correct(self, states, covariances, measurements):
+        # Returns the innovation (measured minus predicted center) per row
+        innovation = measurements - states[:, :2]
+        gain = covariances[:, :, :2] @ np.linalg.inv(covariances[:, :2, :2] + self.measurement_noise)
+        states += (gain @ innovation[..., None])[..., 0]
+        covariances -= gain @ covariances[:, :2, :]
+        return innovation
+
+    def needs_update(self, obj, frame, state):
+        if obj['idle_frames'] >= self.refresh_interval:
+            return True
+        if np.hypot(state[2], state[3]) > self.min_speed or obj['innovation'] > self.innovation_threshold:
+            return True
+        patch = frame_patch(frame, obj['track_bbox'])
+        if obj['reference'].shape != patch.shape:
+            return True
+        return np.mean(cv2.mean(cv2.absdiff(patch, obj['reference']))[:3]) > self.change_threshold
+
+    def stats(self):
+        total = self.updates + self.skipped
+        return {'updates': self.updates, 'skipped': self.skipped, 'skipped_fraction': self.skipped / total if total else 0.0}
+
+# Per-object state flags in ObjectTracker.flags
+HAS_BBOX = 1
+LOST = 2
+
+class ObjectTracker:
+    # Objects are dicts indexed by id. Their ids, main-stream bboxes and state
+    # flags also live in contiguous arrays, one slot per object, so lookups
+    # and removals are O(1) and hit tests and per-frame snapshots are single
+    # NumPy operations. Write bboxes through set_bbox to keep both in step.
+    def __init__(self, capacity=64):
+        self.objects = {}
+        self.ids = np.zeros(capacity, np.int64)
+        self.bboxes = np.zeros((capacity, 4), np.float32)
+        self.flags = np.zeros(capacity, np.uint8)
+        # Kalman state and covariance per slot, used by motion_filter
+        self.states = np.zeros((capacity, 4))
+        self.covariances = np.zeros((capacity, 4, 4))
+        self.count = 0
+        self.tracking = False
+        self.current_id = 0
+        # Main-stream pixels per tracking-frame pixel
+        self.frame_scale = (1.0, 1.0)
+        self.executor = None
+        # Worker processes wanted for sharded tracking (0 = in-process), and
+        # the running shards once they have been started on a frame
+        self.shard_workers = 0
+        self.shards = None
+        # Optional TrackerBudgetPolicy, and update counts/seconds per backend
+        self.budget_policy = None
+        self.backend_stats = {}
+        # Optional ConstantVelocityFilter gating the tracker updates
+        self.motion_filter = None
+
+    def add_object(self, x, y, label, backend=DEFAULT_BACKEND):
+        if self.count == len(self.ids):
+            # Double the slot arrays when they fill up
+            self.ids = np.concatenate([self.ids, np.zeros_like(self.ids)])
+            self.bboxes = np.concatenate([self.bboxes, np.zeros_like(self.bboxes)])
+            self.flags = np.concatenate([self.flags, np.zeros_like(self.flags)])
+            self.states = np.concatenate([self.states, np.zeros_like(self.states)])
+            self.covariances = np.concatenate([self.covariances, np.zeros_like(self.covariances)])
+        obj = {
+            'id': self.current_id,
+            'label': label,
+            'bbox': None,
+            'backend': backend,
+            'tracker': create_tracker(backend),
+            'slot': self.count
+        }
+        self.objects[obj['id']] = obj
+        self.ids[self.count] = obj['id']
+        self.flags[self.count] = 0
+        self.count += 1
+        self.current_id += 1
+        return obj
+
+    def get(self, object_id):
+        return self.objects.get(object_id)
+
+    def set_bbox(self, obj, bbox):
+        # bbox is in main-stream pixels
+        obj['bbox'] = tuple(bbox)
+        self.bboxes[obj['slot']] = bbox
+        self.flags[obj['slot']] = HAS_BBOX
+
+    def tracked_objects(self):
+        # Objects that have a bbox, in slot order
+        ids = self.ids[:self.count][self.flags[:self.count] & HAS_BBOX != 0]
+        return [self.objects[object_id] for object_id in ids.tolist()]
+
+    def bbox_snapshot(self):
+        # Copies of the ids and (x, y, w, h) bboxes of every placed object
+        placed = self.flags[:self.count] & HAS_BBOX != 0
+        return self.ids[:self.count][placed], self.bboxes[:self.count][placed]
+
+    def hit_test(self, x, y):
+        # The most recently added placed object whose bbox contains (x, y)
+        boxes = self.bboxes[:self.count]
+        inside = ((self.flags[:self.count] & HAS_BBOX != 0)
+                  & (boxes[:, 0] < x) & (x < boxes[:, 0] + boxes[:, 2])
+                  & (boxes[:, 1] < y) & (y < boxes[:, 1] + boxes[:, 3]))
+        hits = np.flatnonzero(inside)
+        if len(hits) == 0:
+            return None
+        return self.objects[int(self.ids[hits[np.argmax(self.ids[hits])]])]
+
+    def init_object(self, obj, frame, bbox):
+        # bbox is in tracking-frame pixels. Raises cv2.error when the tracker
+        # rejects it (e.g. CSRT on a box at the frame edge).
+        bbox = tuple(int(v) for v in bbox)
+        sharded = False
+        if self.shards is not None:
+            try:
+                self.shards.init_object(obj['id'], frame, bbox, obj['backend'])
+                sharded = True
+            except (OSError, EOFError, ValueError, IndexError) as e:
+                print(f"Sharded tracking failed ({e}), falling back to in-process tracking")
+                self.shard_workers = 0
+                self.stop_shards(frame, [other for other in self.tracked_objects() if other is not obj])
+        if not sharded:
+            obj['tracker'].init(frame, bbox)
+        obj['track_bbox'] = bbox
+        if self.motion_filter is not None:
+            self.seed_motion(obj, frame)
+
+    def seed_motion(self, obj, frame):
+        # Start the object's filter at rest on its current bbox
+        self.states[obj['slot']], self.covariances[obj['slot']] = self.motion_filter.initial_state(obj['track_bbox'])
+        obj['reference'] = frame_patch(frame, obj['track_bbox']).copy()
+        obj['innovation'] = 0.0
+        obj['idle_frames'] = 0
+
+    def set_motion_filter(self, motion_filter):
+        # Tracks already running are seeded on the next update_all. Call it
+        # between frames (TrackerControl's 'motion' command).
+        self.motion_filter = motion_filter
+        for obj in self.objects.values():
+            obj.pop('reference', None)
+
+    def reseed(self, obj, frame, bbox):
+        # Fresh tracker for the object at bbox (tracking-frame pixels).
+        # Returns whether it took; if not, the old tracker carries on.
+        previous = obj['tracker']
+        try:
+            obj['tracker'] = create_tracker(obj['backend'])
+            self.init_object(obj, frame, bbox)
+        except cv2.error as e:
+            print(f"Could not re-seed {obj['label']} with {obj['backend']} ({e})")
+            obj['tracker'] = previous
+            return False
+        return True
+
+    def switch_backend(self, obj, backend, frame):
+        # Re-seeds the track with the new backend where it was last seen,
+        # staying on the old one if the new tracker rejects the bbox
+        previous = obj['backend']
+        obj['backend'] = backend
+        if not self.reseed(obj, frame, obj['track_bbox']):
+            obj['backend'] = previous
+            return False
+        return True
+
+    def update_label(self, object_id, new_label):
+        obj = self.objects.get(object_id)
+        if obj is not None:
+            obj['label'] = new_label
+
+    def remove_object(self, object_id):
+        obj = self.objects.pop(object_id, None)
+        if obj is None:
+            return
+        # Move the last slot into the freed one
+        slot, last = obj['slot'], self.count - 1
+        if slot != last:
+            moved = self.objects[int(self.ids[last])]
+            moved['slot'] = slot
+            self.ids[slot] = self.ids[last]
+            self.bboxes[slot] = self.bboxes[last]
+            self.flags[slot] = self.flags[last]
+            self.states[slot] = self.states[last]
+            self.covariances[slot] = self.covariances[last]
+        self.count -= 1
+        if self.shards is not None:
+            self.shards.remove_object(object_id)
+
+    def set_parallel(self, workers):
+        # OpenCV drops the GIL inside tracker.update, so a thread pool is
+        # enough to spread the updates over the Pi's cores. Call it between
+        # frames (TrackerControl's 'parallel' command), never during update_all.
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        if workers and workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def set_sharded(self, workers):
+        # Takes effect on the next update_all, which has a frame to re-seed
+        # the trackers on
+        self.shard_workers = workers
+
+    def start_shards(self, frame, objects):
+        try:
+            self.shards = ShardedTracking(self.shard_workers, frame.shape)
+            for obj in objects:
+                self.shards.init_object(obj['id'], frame, obj['track_bbox'], obj['backend'])
+        except (OSError, ValueError, IndexError) as e:
+            print(f"Sharded tracking unavailable ({e}), tracking in-process")
+            self.shard_workers = 0
+            self.stop_shards(frame, objects)
+
+    def stop_shards(self, frame, objects):
+        if self.shards is not None:
+            try:
+                self.shards.close()
+            except OSError:
+                pass
+            self.shards = None
+        # The local trackers went stale while the shards had the objects, so
+        # re-seed them where the shards last saw each one
+        for obj in objects:
+            obj['tracker'] = create_tracker(obj['backend'])
+            obj['tracker'].init(frame, obj['track_bbox'])
+
+    def update_all(self, frame):
+        # Returns (object, success, bbox) for every initialized object, in
+        # object order whatever backend ran the updates
+        objects = self.tracked_objects()
+        if self.shard_workers and self.shards is None:
+            self.start_shards(frame, objects)
+        elif not self.shard_workers and self.shards is not None:
+            self.stop_shards(frame, objects)
+
+        start = time.perf_counter()
+        motion = self.motion_filter
+        slots = np.array([obj['slot'] for obj in objects], int)
+        active = objects
+        if motion is not None and objects:
+            for obj in objects:
+                if 'reference' not in obj:
+                    self.seed_motion(obj, frame)
+            states, covariances = self.states[slots], self.covariances[slots]
+            motion.predict(states, covariances)
+            active = [obj for obj, state in zip(objects, states) if motion.needs_update(obj, frame, state)]
+            motion.updates += len(active)
+            motion.skipped += len(objects) - len(active)
+
+        results = None
+        executor = self.executor
+        if self.shards is not None:
+            try:
+                results = self.shards.update(frame, [obj['id'] for obj in active])
+            except (OSError, EOFError, ValueError) as e:
+                print(f"Sharded tracking failed ({e}), falling back to in-process tracking")
+                self.shard_workers = 0
+                self.stop_shards(frame, objects)
+        if results is None:
+            if executor is None or len(active) < 2:
+                results = [timed_update(obj['tracker'], frame) for obj in active]
+            else:
+                results = executor.map(lambda obj: timed_update(obj['tracker'], frame), active)
+
+        measured = {}
+        for obj, (success, bbox, seconds) in zip(active, results):
+            if success:
+                # Legacy trackers report float bboxes; init wants ints
+                obj['track_bbox'] = tuple(int(v) for v in bbox)
+                self.flags[obj['slot']] &= ~np.uint8(LOST)
+            else:
+                self.flags[obj['slot']] |= LOST
+            obj['last_cost'] = seconds
+            stats = self.backend_stats.setdefault(obj['backend'], {'updates': 0, 'seconds': 0.0})
+            stats['updates'] += 1
+            stats['seconds'] += seconds
+            measured[obj['id']] = (success, bbox)
+
+        if motion is None or not objects:
+            updates = [(obj,) + measured[obj['id']] for obj in active]
+        else:
+            updates = self.apply_motion(objects, slots, states, covariances, measured, frame)
+        elapsed = time.perf_counter() - start
+
+        if self.budget_policy is not None:
+            backend_costs = {backend: stats['seconds'] / stats['updates'] for backend, stats in self.backend_stats.items() if stats['updates']}
+            switch = self.budget_policy.choose_switch(objects, elapsed, backend_costs)
+            if switch is not None:
+                self.switch_backend(switch[0], switch[1], frame)
+        return updates
+
+    def apply_motion(self, objects, slots, states, covariances, measured, frame):
+        # Skipped tracks are measured where they were last seen (their pixels
+        # have not changed), so the velocity settles to zero when idle. Lost
+        # tracks coast on the prediction.
+        motion = self.motion_filter
+        found = np.array([measured.get(obj['id'], (True, None))[0] for obj in objects])
+        measurements = np.array([bbox_center(obj['track_bbox']) for obj in objects], float)
+        innovation = np.full((len(objects), 2), np.inf)
+        if found.any():
+            found_states, found_covariances = states[found], covariances[found]
+            innovation[found] = motion.correct(found_states, found_covariances, measurements[found])
+            states[found], covariances[found] = found_states, found_covariances
+        self.states[slots], self.covariances[slots] = states, covariances
+
+        updates = []
+        for obj, state, was_found, offset in zip(objects, states, found, np.hypot(innovation[:, 0], innovation[:, 1])):
+            obj['innovation'] = offset
+            if obj['id'] in measured:
+                obj['idle_frames'] = 0
+                if was_found:
+                    obj['reference'] = frame_patch(frame, obj['track_bbox']).copy()
+            else:
+                obj['idle_frames'] += 1
+            _, _, w, h = obj['track_bbox']
+            bbox = (int(round(state[0] - w / 2)), int(round(state[1] - h / 2)), int(w), int(h))
+            updates.append((obj, bool(was_found), bbox))
+        return updates
+
+    def backend_summary(self):
+        # Average update cost and current track count per backend
+        summary = {}
+        for backend in BACKEND_LADDER:
+            stats = self.backend_stats.get(backend, {'updates': 0, 'seconds': 0.0})
+            tracks = sum(1 for obj in self.objects.values() if obj['backend'] == backend)
+            if stats['updates'] or tracks:
+                average = stats['seconds'] / stats['updates'] if stats['updates'] else 0.0
+                summary[backend] = {'tracks': tracks, 'updates': stats['updates'], 'avg_ms': average * 1000}
+        return summary
+
+    def close(self):
+        self.set_parallel(None)
+        if self.shards is not None:
+            self.shards.close()
+            self.shards = None
+
+@functools.lru_cache(maxsize=None)
+def get_object_color(label):
+    # crc32 rather than hash(), which is salted per process, so a label keeps
+    # its color from one run to the next
+    hash_value = zlib.crc32(label.encode())
+    r = (hash_value & 0xFF0000) >> 16
+    g = (hash_value & 0x00FF00) >> 8
+    b = hash_value & 0x0000FF
+    return (r, g, b)
+
+PARTICLES_PER_OBJECT = 20
+particle_rng = np.random.default_rng()
+
+def create_particle_effects(frame, bboxes, colors):
+    # Every object's particles in one batch: start points anywhere in the
+    # bbox, random directions, 5-15 px long. The segments are then drawn with
+    # one polylines call per color instead of one cv2.line per particle.
+    boxes = np.asarray(bboxes, np.float64).reshape(-1, 4)
+    if not len(boxes):
+        return
+    count = len(boxes) * PARTICLES_PER_OBJECT
+    origins = np.repeat(boxes[:, :2], PARTICLES_PER_OBJECT, axis=0)
+    sizes = np.repeat(boxes[:, 2:], PARTICLES_PER_OBJECT, axis=0)
+    starts = np.floor(origins + particle_rng.random((count, 2)) * (sizes + 1))
+    angles = particle_rng.uniform(0, 2 * np.pi, count)
+    lengths = particle_rng.integers(5, 16, count)[:, None]
+    ends = starts + lengths * np.stack([np.cos(angles), np.sin(angles)], axis=1)
+    segments = np.stack([starts, ends], axis=1).astype(np.int32).reshape(len(boxes), PARTICLES_PER_OBJECT, 2, 2)
+
+    by_color = {}
+    for object_segments, color in zip(segments, colors):
+        by_color.setdefault(tuple(color), []).append(object_segments)
+    for color, groups in by_color.items():
+        cv2.polylines(frame, list(np.concatenate(groups)), False, color, 1)
+
+def create_particle_effect(frame, bbox, color):
+    create_particle_effects(frame, [bbox], [color])
+
+def draw_pretty_object(frame, label, bbox, color, particles=True):
+    x, y, w, h = bbox
+    cv2.rectangle(frame, (x, y), (x + w, y + h), color, 2)
+    if particles:
+        create_particle_effect(frame, bbox, color)
+    cv2.putText(frame, label, (x, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2, cv2.LINE_8)
+
+LABEL_FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+@functools.lru_cache(maxsize=1024)
+def label_extent(label, font_scale=0.5, thickness=2):
+    # Width, and height above/below the baseline, of a label
+    (w, h), baseline = cv2.getTextSize(label, LABEL_FONT, font_scale, thickness)
+    return w, h, baseline
+
+class OverlayLayer:
+    # Retained overlay for the tracked objects' boxes and labels. They are
+    # rendered into a layer image plus mask, and an object is only redrawn
+    # when its label, bbox or color changes; its old and new footprints are
+    # cleared and anything else overlapping them is redrawn. The layer then
+    # goes onto each frame with one masked copy. The defaults match
+    # draw_pretty_object; thinner strokes suit a display-sized frame.
+    def __init__(self, font_scale=0.5, thickness=2):
+        self.font_scale = font_scale
+        self.thickness = thickness
+        self.layer = None
+        self.mask = None
+        self.drawn = {}  # object id -> (label, bbox, color, footprint)
+        self.rerendered = 0
+
+    def footprint(self, label, bbox):
+        # (x0, y0, x1, y1) covering the box outline and the label above it,
+        # clipped to the layer
+        x, y, w, h = bbox
+        text_w, text_h, baseline = label_extent(label, self.font_scale, self.thickness)
+        frame_h, frame_w = self.layer.shape[:2]
+        x0 = max(x - 2, 0)
+        y0 = max(min(y - 10 - text_h, y) - 2, 0)
+        x1 = min(max(x + w, x + text_w) + 3, frame_w)
+        y1 = min(max(y + h, y - 10 + baseline) + 3, frame_h)
+        return x0, y0, max(x1, x0), max(y1, y0)
+
+    def render(self, label, bbox, footprint, color):
+        # The glyphs are drawn as coverage into a scratch patch first, because
+        # some OpenCV builds antialias Hershey text even with LINE_8; painting
+        # the covered pixels in solid color keeps the mask binary.
+        x, y, w, h = bbox
+        x0, y0, x1, y1 = footprint
+        coverage = np.zeros((y1 - y0, x1 - x0), np.uint8)
+        cv2.rectangle(coverage, (x - x0, y - y0), (x - x0 + w, y - y0 + h), 255, self.thickness)
+        cv2.putText(coverage, label, (x - x0, y - y0 - 10), LABEL_FONT, self.font_scale, 255, self.thickness, cv2.LINE_8)
+        covered = coverage >= 128
+        self.layer[y0:y1, x0:x1][covered] = color
+        self.mask[y0:y1, x0:x1][covered] = 255
+
+    def update(self, frame_shape, items):
+        # items: (object id, label, bbox, color) for everything to show
+        if self.layer is None or self.layer.shape != frame_shape:
+            self.layer = np.zeros(frame_shape, np.uint8)
+            self.mask = np.zeros(frame_shape[:2], np.uint8)
+            self.drawn = {}
+        current = {object_id: (label, tuple(int(v) for v in bbox), tuple(color)) for object_id, label, bbox, color in items}
+        dirty = [self.drawn[object_id][3] for object_id in self.drawn
+                 if object_id not in current or current[object_id] != self.drawn[object_id][:3]]
+        changed = [object_id for object_id, state in current.items()
+                   if object_id not in self.drawn or self.drawn[object_id][:3] != state]
+        if not dirty and not changed:
+            return
+        footprints = {object_id: self.footprint(state[0], state[1]) for object_id, state in current.items()}
+        dirty += [footprints[object_id] for object_id in changed]
+        for x0, y0, x1, y1 in dirty:
+            self.layer[y0:y1, x0:x1] = 0
+            self.mask[y0:y1, x0:x1] = 0
+
+        # Anything touching a cleared region has lost pixels and is redrawn
+        self.drawn = {}
+        for object_id, (label, bbox, color) in current.items():
+            x0, y0, x1, y1 = footprints[object_id]
+            if any(x0 < dx1 and dx0 < x1 and y0 < dy1 and dy0 < y1 for dx0, dy0, dx1, dy1 in dirty):
+                self.render(label, bbox, footprints[object_id], color)
+                self.rerendered += 1
+            self.drawn[object_id] = (label, bbox, color, footprints[object_id])
+
+    def composite(self, frame):
+        if self.layer is not None and self.layer.shape == frame.shape:
+            cv2.copyTo(self.layer, self.mask, frame)
+
+def place_object(tracker, tracker_frame, scale, bbox, label=None):
+    # bbox is in main-stream pixels; the tracker is initialised on the
+    # tracking frame at its own scale. Raises cv2.error, leaving no object
+    # behind, when the tracker rejects the bbox.
+    x, y, w, h = bbox
+    obj = tracker.add_object(x + w // 2, y + h // 2, label or f"Mini {tracker.current_id}")
+    try:
+        tracker.init_object(obj, tracker_frame, scale_bbox(bbox, (1 / scale[0], 1 / scale[1])))
+    except cv2.error:
+        tracker.remove_object(obj['id'])
+        raise
+    tracker.set_bbox(obj, bbox)
+    return obj
+
+class CommandQueue:
+    # Edits from the display thread (clicks, drags, typed labels) queue up
+    # here as tuples and are applied by the processing thread between frames,
+    # so nothing that waits on a person ever runs inside the frame loop.
+    # Commands that need an object's id carry a ticket dict; an 'add' fills in
+    # the new id, so a label typed later can still find the object, and a
+    # ('pick', (x, y), ticket) fills in the id and label of the object under
+    # a main-stream point, or sets 'missed'. Hit tests run here rather than on
+    # the display thread because removals move objects between slots.
+    # ('control', request, reply) carries a structured request from the menu
+    # or the control server; its result dict is passed to reply.
+    def __init__(self):
+        self.commands = collections.deque()
+        self.frame_size = None  # Main-stream (w, h), set by the processing thread
+        self.control = None  # TrackerControl, set once the pipeline exists
+
+    def put(self, command):
+        self.commands.append(command)
+
+    def apply(self, tracker, tracker_frame, scale):
+        while self.commands:
+            command = self.commands.popleft()
+            if command[0] == 'add':
+                _, bbox, label, ticket = command
+                try:
+                    obj = place_object(tracker, tracker_frame, scale, bbox, label)
+                except cv2.error as e:
+                    print(f"Could not track the box {bbox} ({e})")
+                    continue
+                ticket['id'] = obj['id']
+            elif command[0] == 'pick':
+                _, (x, y), ticket = command
+                obj = tracker.hit_test(x, y)
+                if obj is None:
+                    ticket['missed'] = True
+                else:
+                    ticket['label'] = obj['label']
+                    ticket['id'] = obj['id']
+            elif command[0] == 'control':
+                _, request, reply = command
+                reply(self.control.execute(request, tracker_frame, scale))
+            elif command[0] == 'relabel':
+                _, ticket, label = command
+                if 'id' in ticket:
+                    tracker.update_label(ticket['id'], label)
+            elif command[0] == 'remove':
+                _, ticket = command
+                if 'id' in ticket:
+                    tracker.remove_object(ticket['id'])
+
+class LabelEditor:
+    # Label entry typed into the tracking window itself. Keys arrive from the
+    # display loop's waitKey; Enter queues the relabel, Esc cancels.
+    def __init__(self, commands):
+        self.commands = commands
+        self.ticket = None
+        self.text = ""
+
+    def start(self, ticket, text=None):
+        # Without text, editing starts from the label a queued 'pick' finds
+        self.ticket = ticket
+        self.text = text
+
+    def resolve(self):
+        # Picks in the ticket are filled in by the processing thread
+        if self.ticket is None or self.text is not None:
+            return
+        if self.ticket.get('missed'):
+            self.ticket = None
+        elif 'label' in self.ticket:
+            self.text = self.ticket['label']
+
+    def active(self):
+        self.resolve()
+        return self.ticket is not None
+
+    def key(self, code):
+        # Returns whether the key was consumed
+        if not self.active() or code < 0:
+            return False
+        if self.text is None:
+            self.text = ""  # Typed before the pick came back
+        code &= 0xFF
+        if code in (10, 13):
+            if self.text:
+                self.commands.put(('relabel', self.ticket, self.text))
+            self.ticket = None
+        elif code == 27:
+            self.ticket = None
+        elif code in (8, 127):
+            self.text = self.text[:-1]
+        elif 32 <= code < 127:
+            self.text += chr(code)
+        return True
+
+    def draw(self, frame):
+        if not self.active() or self.text is None:
+            return
+        h, w = frame.shape[:2]
+        cv2.rectangle(frame, (0, h - 28), (w, h), (0, 0, 0), -1)
+        cv2.putText(frame, f"Label: {self.text}_  (Enter to save, Esc to cancel)", (8, h - 9),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1, cv2.LINE_8)
+
+class MouseInteraction:
+    # Window mouse handling without blocking: drag out a box to add a mini
+    # (tracked at once, labelled when typed), click a mini to relabel it,
+    # right-click one to remove it. Window coordinates are display pixels and
+    # are mapped to main-stream pixels before anything is queued; even the hit
+    # test is queued, since only the processing thread may touch the tracker.
+    def __init__(self, commands, editor, display_size=(960, 540), min_drag=6):
+        self.commands = commands
+        self.editor = editor
+        self.display_size = display_size
+        self.min_drag = min_drag
+        self.drag_start = None
+        self.drag_end = None
+
+    def to_main(self, x, y):
+        frame_w, frame_h = self.commands.frame_size or self.display_size
+        return x * frame_w / self.display_size[0], y * frame_h / self.display_size[1]
+
+    def on_mouse(self, event, x, y, flags, param):
+        if event == cv2.EVENT_LBUTTONDOWN:
+            self.drag_start = self.drag_end = (x, y)
+        elif event == cv2.EVENT_MOUSEMOVE and self.drag_start is not None:
+            self.drag_end = (x, y)
+        elif event == cv2.EVENT_LBUTTONUP and self.drag_start is not None:
+            (x0, y0), self.drag_start = self.drag_start, None
+            if abs(x - x0) < self.min_drag or abs(y - y0) < self.min_drag:
+                ticket = {}
+                self.commands.put(('pick', self.to_main(x, y), ticket))
+                self.editor.start(ticket)
+                return
+            left, top = self.to_main(min(x, x0), min(y, y0))
+            right, bottom = self.to_main(max(x, x0), max(y, y0))
+            ticket = {}
+            self.commands.put(('add', (int(left), int(top), int(right - left), int(bottom - top)), None, ticket))
+            self.editor.start(ticket, "")
+        elif event == cv2.EVENT_RBUTTONUP:
+            # The pick runs first, so the remove sees the id it found
+            ticket = {}
+            self.commands.put(('pick', self.to_main(x, y), ticket))
+            self.commands.put(('remove', ticket))
+
+    def draw(self, frame):
+        # The box being dragged, on the display frame
+        if self.drag_start is not None and self.drag_end is not None:
+            cv2.rectangle(frame, self.drag_start, self.drag_end, (255, 255, 255), 1)
+        self.editor.draw(frame)
+
+class FrameBufferPool:
+    # Named, reusable output buffers for the per-frame path. A buffer is only
+    # (re)allocated when its shape or dtype changes, and every allocation is
+    # counted so steady state can be checked to allocate nothing.
+    def __init__(self):
+        self.buffers = {}
+        self.slot_index = {}
+        self.frame_bytes = 0
+        self.last_frame_bytes = 0
+        self.total_bytes = 0
+        self.frames = 0
+
+    def get(self, name, shape, dtype=np.uint8, slots=1):
+        # slots > 1 hands out buffers round-robin, for results that are
+        # still being read by another stage while the next one is written
+        entry = self.buffers.get(name)
+        if entry is None or len(entry) != slots or entry[0].shape != tuple(shape) or entry[0].dtype != dtype:
+            entry = [np.empty(shape, dtype) for _ in range(slots)]
+            self.buffers[name] = entry
+            self.slot_index[name] = 0
+            allocated = sum(buf.nbytes for buf in entry)
+            self.frame_bytes += allocated
+            self.total_bytes += allocated
+        index = self.slot_index[name]
+        self.slot_index[name] = (index + 1) % slots
+        return entry[index]
+
+    def begin_frame(self):
+        self.frame_bytes = 0
+
+    def end_frame(self):
+        self.last_frame_bytes = self.frame_bytes
+        self.frames += 1
+
+    def stats(self):
+        return {
+            'bytes_allocated_last_frame': self.last_frame_bytes,
+            'bytes_allocated_total': self.total_bytes,
+            'pooled_bytes': sum(buf.nbytes for entry in self.buffers.values() for buf in entry),
+        }
+
+def pool_buffer(buffer_pool, name, shape, dtype=np.uint8, slots=1):
+    # OpenCV allocates its own output when dst is None
+    if buffer_pool is None:
+        return None
+    return buffer_pool.get(name, shape, dtype, slots)
+
+# Shape limits for is_mini_shape. 'outline' is the mini_test_9 heuristic
+# (complex outlines), 'upright' the mini_test_8 one (taller-than-wide figures).
+MINI_SHAPE_HEURISTICS = {
+    'outline': {'min_area': 500, 'max_area': 20000, 'min_vertices': 5, 'max_solidity': 0.95},
+    'upright': {'min_area': 100, 'max_area': 10000, 'min_aspect_ratio': 0.3, 'max_aspect_ratio': 3, 'upright': True, 'max_solidity': 0.95},
+}
+
+# Edge detection settings by input resolution. The 1080p ones break most
+# outlines on the 640x360 luma (the 5x5 blur smears them and Canny leaves
+# gaps), so frames at half resolution or less get a 3x3 blur, their edges
+# closed with a 3x3 kernel, and a finer polygon approximation.
+EDGE_PARAMETERS = {
+    'main': {'blur': 5, 'close': 0, 'epsilon': 0.02},
+    'lores': {'blur': 3, 'close': 3, 'epsilon': 0.015},
+}
+
+def edge_parameters(area_scale):
+    # area_scale is main-stream pixels per frame pixel
+    return EDGE_PARAMETERS['lores' if area_scale >= 4 else 'main']
+
+def is_mini_shape(contour, limits, area_scale=1.0, epsilon_fraction=0.02):
+    # One contour against MINI_SHAPE_HEURISTICS limits, cheapest check first
+    area = cv2.contourArea(contour)
+    if not limits['min_area'] <= area * area_scale <= limits['max_area']:
+        return False
+    if 'min_aspect_ratio' in limits or limits.get('upright'):
+        _, _, w, h = cv2.boundingRect(contour)
+        if 'min_aspect_ratio' in limits and not limits['min_aspect_ratio'] <= w / h <= limits['max_aspect_ratio']:
+            return False
+        if limits.get('upright') and h < w:
+            return False
+    if 'min_vertices' in limits:
+        epsilon = epsilon_fraction * cv2.arcLength(contour, True)
+        if len(cv2.approxPolyDP(contour, epsilon, True)) < limits['min_vertices']:
+            return False
+    return area / cv2.contourArea(cv2.convexHull(contour)) <= limits['max_solidity']
+
+def select_mini_shapes(contours, heuristic='outline', area_scale=1.0):
+    # The contours that pass is_mini_shape, in their original order
+    limits = MINI_SHAPE_HEURISTICS[heuristic]
+    epsilon_fraction = edge_parameters(area_scale)['epsilon']
+    return [contour for contour in contours if is_mini_shape(contour, limits, area_scale, epsilon_fraction)]
+
+def scale_bbox(bbox, scale):
+    x, y, w, h = bbox
+    return (int(x * scale[0]), int(y * scale[1]), int(w * scale[0]), int(h * scale[1]))
+
+def scale_contour(contour, scale):
+    return np.round(contour * np.array(scale)).astype(np.int32)
+
+def to_gray(frame, buffer_pool=None):
+    # A single-channel frame (e.g. the lores Y plane) is used as-is
+    if frame.ndim == 2:
+        return frame
+    h, w = frame.shape[:2]
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=pool_buffer(buffer_pool, 'gray', (h, w)))
+
+def find_edge_contours(gray, blurred=None, edges=None, offset=(0, 0), area_scale=1.0):
+    parameters = edge_parameters(area_scale)
+    blur = parameters['blur']
+    blurred = cv2.GaussianBlur(gray, (blur, blur), 0, dst=blurred)
+    edges = cv2.Canny(blurred, 50, 150, edges=edges)
+    if parameters['close']:
+        kernel = np.ones((parameters['close'], parameters['close']), np.uint8)
+        edges = cv2.morphologyEx(edges, cv2.MORPH_CLOSE, kernel, dst=edges)
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
+    return contours
+
+def finish_detection(contours, heuristic, scale, rescale):
+    mini_contours = select_mini_shapes(contours, heuristic, scale[0] * scale[1])
+    if rescale and scale != (1.0, 1.0):
+        mini_contours = [scale_contour(cnt, scale) for cnt in mini_contours]
+    return mini_contours
+
+def detect_minis(frame, buffer_pool=None, scale=(1.0, 1.0), rescale=True, heuristic='outline'):
+    # scale maps frame pixels to main-stream pixels; results come back in the
+    # latter unless rescale is False
+    h, w = frame.shape[:2]
+    gray = to_gray(frame, buffer_pool)
+    contours = find_edge_contours(gray, pool_buffer(buffer_pool, 'blurred', (h, w)), pool_buffer(buffer_pool, 'edges', (h, w)),
+                                  area_scale=scale[0] * scale[1])
+    return finish_detection(contours, heuristic, scale, rescale)
+
+def detect_minis_pyramid(frame, buffer_pool=None, scale=(1.0, 1.0), levels=1, padding=6, rescale=True, heuristic='outline'):
+    # Coarse-to-fine: look for candidate blobs on a frame shrunk by 2**levels,
+    # then run the full-resolution edge/contour pass only inside those regions.
+    # levels is the speed/accuracy knob; 0 is the plain full-frame path, and
+    # every extra level is faster but more likely to miss small or faint minis.
+    if levels <= 0:
+        return detect_minis(frame, buffer_pool, scale, rescale, heuristic)
+
+    h, w = frame.shape[:2]
+    gray = to_gray(frame, buffer_pool)
+    small = gray
+    for level in range(levels):
+        small_shape = ((small.shape[0] + 1) // 2, (small.shape[1] + 1) // 2)
+        small = cv2.pyrDown(small, dst=pool_buffer(buffer_pool, f'pyramid_{level}', small_shape))
+    factor = 2 ** levels
+    area_scale = scale[0] * scale[1]
+    coarse_contours = find_edge_contours(small, pool_buffer(buffer_pool, 'coarse_blurred', small.shape), pool_buffer(buffer_pool, 'coarse_edges', small.shape),
+                                         area_scale=area_scale * factor * factor)
+
+    # A contour never covers more than its bounding box, so boxes that are too
+    # small to hold a mini can be dropped without losing anything. Survivors
+    # are painted into a mask so overlapping candidates merge into one region.
+    min_area = MINI_SHAPE_HEURISTICS[heuristic]['min_area']
+    mask = pool_buffer(buffer_pool, 'candidates', small.shape)
+    if mask is None:
+        mask = np.zeros(small.shape, np.uint8)
+    else:
+        mask[:] = 0
+    for contour in coarse_contours:
+        x, y, cw, ch = cv2.boundingRect(contour)
+        if cw * ch * factor * factor * area_scale < min_area:
+            continue
+        cv2.rectangle(mask, (x - 1, y - 1), (x + cw, y + ch), 255, -1)
+    regions, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    blurred = pool_buffer(buffer_pool, 'blurred', (h, w))
+    edges = pool_buffer(buffer_pool, 'edges', (h, w))
+    candidates = []
+    for region in regions:
+        x, y, rw, rh = cv2.boundingRect(region)
+        x0, y0 = max(x * factor - padding, 0), max(y * factor - padding, 0)
+        x1, y1 = min((x + rw) * factor + padding, w), min((y + rh) * factor + padding, h)
+        contours = find_edge_contours(
+            gray[y0:y1, x0:x1],
+            None if blurred is None else blurred[y0:y1, x0:x1],
+            None if edges is None else edges[y0:y1, x0:x1],
+            offset=(x0, y0), area_scale=area_scale)
+        candidates.extend(contours)
+
+    return finish_detection(candidates, heuristic, scale, rescale)
+
+def benchmark_detection(image_paths, iterations=30, max_levels=3):
+    # Compare the full-frame detect_minis against each pyramid level on real
+    # frames. Recall is the share of full-frame detections whose center falls
+    # inside a pyramid detection. Without images, one lores luma from the
+    # camera (or a synthetic map off the Pi) is used at its main-stream scale.
+    scale = (1.0, 1.0)
+    if image_paths:
+        frames = [cv2.imread(path, cv2.IMREAD_GRAYSCALE) for path in image_paths]
+    else:
+        source = PicameraSource() if Picamera2 is not None else SyntheticSource(free_running=True, frames=1)
+        main_frame, luma, _ = source.read()
+        frames = [luma.copy()]
+        scale = (main_frame.shape[1] / luma.shape[1], main_frame.shape[0] / luma.shape[0])
+        source.close()
+
+    buffer_pool = FrameBufferPool()
+    results = {}
+    for levels in range(max_levels + 1):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            for frame in frames:
+                detections = detect_minis_pyramid(frame, buffer_pool, scale, levels, rescale=False)
+        elapsed = time.perf_counter() - start
+        results[levels] = (iterations * len(frames) / elapsed, [detect_minis_pyramid(frame, buffer_pool, scale, levels, rescale=False) for frame in frames])
+
+    base_fps, base_detections = results[0]
+    print(f"Full frame: {base_fps:.1f} fps, {sum(len(d) for d in base_detections)} minis")
+    for levels in range(1, max_levels + 1):
+        fps, detections = results[levels]
+        found = 0
+        for frame_base, frame_detections in zip(base_detections, detections):
+            boxes = [cv2.boundingRect(cnt) for cnt in frame_detections]
+            for cnt in frame_base:
+                x, y, w, h = cv2.boundingRect(cnt)
+                cx, cy = x + w / 2, y + h / 2
+                if any(bx <= cx <= bx + bw and by <= cy <= by + bh for bx, by, bw, bh in boxes):
+                    found += 1
+        total = sum(len(d) for d in base_detections)
+        recall = f"{found / total:.0%}" if total else "n/a"
+        print(f"Pyramid level {levels}: {fps:.1f} fps ({fps / base_fps:.2f}x), {sum(len(d) for d in detections)} minis, recall {recall}")
+
+class IncrementalDetector:
+    # Most of a session is a static map, so only tiles that changed since they
+    # were last detected are re-run; the rest reuse their cached contours.
+    # Changes are measured against the pixels each tile was last detected on,
+    # so slow movement still adds up to a re-detection eventually.
+    def __init__(self, tile_size=64, change_threshold=25, min_changed_fraction=0.02, refresh_interval=150):
+        self.tile_size = tile_size
+        self.change_threshold = change_threshold
+        self.min_changed_fraction = min_changed_fraction
+        self.refresh_interval = refresh_interval
+        self.enabled = True
+        self.levels = 0  # Pyramid levels for full refreshes
+        self.heuristic = 'outline'
+        self.reference = None
+        self.scale = None
+        self.tile_contours = {}
+        self.frames_since_refresh = 0
+        self.last_redetected_tiles = 0
+        self.total_tiles = 0
+
+    def detect(self, frame, buffer_pool=None, scale=(1.0, 1.0)):
+        if not self.enabled:
+            self.reference = None
+            return detect_minis_pyramid(frame, buffer_pool, scale, self.levels, heuristic=self.heuristic)
+
+        gray = to_gray(frame, buffer_pool)
+        h, w = gray.shape
+        rows = (h + self.tile_size - 1) // self.tile_size
+        cols = (w + self.tile_size - 1) // self.tile_size
+        self.total_tiles = rows * cols
+
+        if (self.reference is None or self.reference.shape != gray.shape or self.scale != scale
+                or self.frames_since_refresh >= self.refresh_interval):
+            self.refresh(gray, buffer_pool, scale, rows, cols)
+        else:
+            self.update_changed_tiles(gray, buffer_pool, scale, rows, cols)
+            self.frames_since_refresh += 1
+
+        return [cnt for contours in self.tile_contours.values() for cnt, _ in contours]
+
+    def tile_of(self, bbox):
+        x, y, w, h = bbox
+        return ((y + h // 2) // self.tile_size, (x + w // 2) // self.tile_size)
+
+    def store(self, contours, scale, tiles):
+        # Cached as (contour in main-stream pixels, bbox in frame pixels).
+        # Contours centered outside tiles are dropped; those tiles keep theirs.
+        tiles = set(tiles)
+        for tile in tiles:
+            self.tile_contours[tile] = []
+        for contour in contours:
+            bbox = cv2.boundingRect(contour)
+            tile = self.tile_of(bbox)
+            if tile in tiles:
+                if scale != (1.0, 1.0):
+                    contour = scale_contour(contour, scale)
+                self.tile_contours[tile].append((contour, bbox))
+
+    def touched_tiles(self, changed_tiles):
+        # Changed tiles plus the home tile of every cached contour whose bbox
+        # overlaps one. A mini moving out can leave its home tile under the
+        # change threshold, so its stale contour is only caught by overlap.
+        touched = changed_tiles.copy()
+        for (row, col), contours in self.tile_contours.items():
+            if touched[row, col]:
+                continue
+            for _, (x, y, w, h) in contours:
+                rows = slice(y // self.tile_size, (y + h - 1) // self.tile_size + 1)
+                cols = slice(x // self.tile_size, (x + w - 1) // self.tile_size + 1)
+                if changed_tiles[rows, cols].any():
+                    touched[row, col] = True
+                    break
+        return touched
+
+    def refresh(self, gray, buffer_pool, scale, rows, cols):
+        # Left in frame pixels so they can be binned by tile
+        contours = detect_minis_pyramid(gray, buffer_pool, scale, self.levels, rescale=False, heuristic=self.heuristic)
+        self.tile_contours = {}
+        self.store(contours, scale, [(row, col) for row in range(rows) for col in range(cols)])
+        self.reference = gray.copy()
+        self.scale = scale
+        self.frames_since_refresh = 0
+        self.last_redetected_tiles = rows * cols
+
+    def update_changed_tiles(self, gray, buffer_pool, scale, rows, cols):
+        h, w = gray.shape
+        diff = cv2.absdiff(gray, self.reference, dst=pool_buffer(buffer_pool, 'tile_diff', (h, w)))
+        changed = diff > self.change_threshold
+        starts_y = np.arange(0, h, self.tile_size)
+        starts_x = np.arange(0, w, self.tile_size)
+        counts = np.add.reduceat(np.add.reduceat(changed, starts_y, axis=0), starts_x, axis=1)
+        changed_tiles = counts >= self.min_changed_fraction * self.tile_size * self.tile_size
+        if not changed_tiles.any():
+            self.last_redetected_tiles = 0
+            return
+        changed_tiles = self.touched_tiles(changed_tiles)
+        self.last_redetected_tiles = int(changed_tiles.sum())
+
+        # Detect in windows one tile wider than the re-detected area so minis
+        # that straddle a tile border are seen whole, then keep only the
+        # contours centered in a re-detected tile. Cached contours elsewhere
+        # stay as they are.
+        grid = changed_tiles.astype(np.uint8)
+        windows, _ = cv2.findContours(cv2.dilate(grid, np.ones((3, 3), np.uint8)), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        candidates = []
+        for window in windows:
+            col, row, tile_cols, tile_rows = cv2.boundingRect(window)
+            x0, y0 = col * self.tile_size, row * self.tile_size
+            x1, y1 = min((col + tile_cols) * self.tile_size, w), min((row + tile_rows) * self.tile_size, h)
+            candidates.extend(find_edge_contours(gray[y0:y1, x0:x1], offset=(x0, y0), area_scale=scale[0] * scale[1]))
+        contours = select_mini_shapes(candidates, self.heuristic, scale[0] * scale[1])
+
+        tiles = [tuple(tile) for tile in np.argwhere(changed_tiles)]
+        self.store(contours, scale, tiles)
+        for row, col in tiles:
+            tile = (slice(row * self.tile_size, (row + 1) * self.tile_size), slice(col * self.tile_size, (col + 1) * self.tile_size))
+            self.reference[tile] = gray[tile]
+
+    def stats(self):
+        return {
+            'redetected_tiles': self.last_redetected_tiles,
+            'total_tiles': self.total_tiles,
+            'cached_minis': sum(len(contours) for contours in self.tile_contours.values()),
+        }
+
+def synthetic_tracking_frames(count, frames, size=(640, 360), seed=0):
+    # A textured background with `count` textured patches drifting across it,
+    # enough for KCF to lock on to. Returns the frames and the initial bboxes.
+    rng = np.random.default_rng(seed)
+    w, h = size
+    background = cv2.GaussianBlur(rng.integers(0, 255, (h, w), np.uint8), (0, 0), 3)
+    patch_w, patch_h = 32, 40
+    patches = [rng.integers(0, 255, (patch_h, patch_w), np.uint8) for _ in range(count)]
+    positions = rng.uniform((20, 20), (w - 60, h - 60), (count, 2))
+    velocities = rng.uniform(-1.5, 1.5, (count, 2))
+    sequence = []
+    for index in range(frames):
+        frame = background.copy()
+        for patch, (x, y), (vx, vy) in zip(patches, positions, velocities):
+            px = int(np.clip(x + vx * index, 0, w - patch_w))
+            py = int(np.clip(y + vy * index, 0, h - patch_h))
+            frame[py:py + patch_h, px:px + patch_w] = patch
+        sequence.append(frame)
+    bboxes = [(int(x), int(y), patch_w, patch_h) for x, y in positions]
+    return sequence, bboxes
+
+def benchmark_tracking(counts=(1, 2, 5, 10, 20, 30), frames=60, workers=4):
+    # Per-frame KCF update cost for growing numbers of tracked minis, with the
+    # updates run one after another, on a thread pool and in worker processes
+    print(f"{'minis':>5} {'sequential fps':>15} {'threads fps':>12} {'processes fps':>14}")
+    for count in counts:
+        sequence, bboxes = synthetic_tracking_frames(count, frames)
+        sequence = [tracking_input(frame) for frame in sequence]
+        fps = []
+        for mode in ('sequential', 'threads', 'processes'):
+            tracker = ObjectTracker()
+            if mode == 'threads':
+                tracker.set_parallel(workers)
+            elif mode == 'processes':
+                tracker.set_sharded(workers)
+                tracker.update_all(sequence[0])  # Start the shards outside the timing
+            for index, bbox in enumerate(bboxes):
+                obj = tracker.add_object(0, 0, f"mini {index}")
+                tracker.init_object(obj, sequence[0], bbox)
+                tracker.set_bbox(obj, bbox)
+            start = time.perf_counter()
+            for frame in sequence[1:]:
+                tracker.update_all(frame)
+            fps.append((frames - 1) / (time.perf_counter() - start))
+            tracker.close()
+        print(f"{count:>5} {fps[0]:>15.1f} {fps[1]:>12.1f} {fps[2]:>14.1f}")
+
+def synthetic_battle_map(size=(1280, 720), minis=12, noise=3.0, motion=0.0, frames=1, seed=0):
+    # A parchment map with a one-inch grid and `minis` mini-shaped blobs (a
+    # round base with an irregular figure reaching past it, so the outline is
+    # not convex), plus Gaussian sensor noise.
+    # Every mini drifts `motion` pixels per frame in a random direction.
+    # Returns the BGR frames and the mini bboxes in each frame.
+    rng = np.random.default_rng(seed)
+    w, h = size
+    unit = max(w // 40, 8)  # One grid square
+    background = np.empty((h, w, 3), np.uint8)
+    background[:] = (170, 205, 225)
+    for x in range(0, w, unit):
+        cv2.line(background, (x, 0), (x, h - 1), (125, 150, 170), 1)
+    for y in range(0, h, unit):
+        cv2.line(background, (0, y), (w - 1, y), (125, 150, 170), 1)
+
+    radius = int(unit * 0.8)
+    angles = np.linspace(0, 2 * np.pi, 9)[:-1]
+    figures = []
+    for _ in range(minis):
+        # Alternating long and short spokes give a non-convex outline
+        spokes = radius * np.where(np.arange(8) % 2, rng.uniform(0.3, 0.5, 8), rng.uniform(0.8, 1.0, 8))
+        figures.append(np.stack([spokes * np.cos(angles), spokes * np.sin(angles)], axis=1))
+    colors = rng.integers(20, 110, (minis, 3))
+    positions = rng.uniform(radius + 2, (w - radius - 2, h - radius - 2), (minis, 2))
+    headings = rng.uniform(0, 2 * np.pi, minis)
+    velocities = motion * np.stack([np.cos(headings), np.sin(headings)], axis=1)
+
+    # OpenCV's generator is far quicker than NumPy's for frame-sized noise
+    cv2.setRNGSeed(seed)
+    grain = np.empty((h, w, 3), np.int16)
+    sequence, bboxes = [], []
+    for index in range(frames):
+        frame = background.copy()
+        centers = np.clip(positions + velocities * index, radius + 2, (w - radius - 2, h - radius - 2))
+        for (cx, cy), figure, color in zip(centers, figures, colors):
+            center = (int(cx), int(cy))
+            cv2.circle(frame, center, int(radius * 0.6), (60, 60, 60), -1)
+            cv2.fillPoly(frame, [np.int32(figure + (cx, cy))], tuple(int(c) for c in color))
+        if noise:
+            cv2.randn(grain, 0, noise)
+            frame = cv2.add(frame, grain, dtype=cv2.CV_8U)
+        sequence.append(frame)
+        bboxes.append([(int(cx) - radius, int(cy) - radius, 2 * radius, 2 * radius) for cx, cy in centers])
+    return sequence, bboxes
+
+def time_call(function, iterations):
+    # Median and p95 wall time of `function` in milliseconds
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+    return {'median_ms': float(np.median(times)), 'p95_ms': float(np.percentile(times, 95)), 'iterations': iterations}
+
+def benchmark_module(name, module, sequence, bboxes, iterations):
+    # Times whichever of the detector/renderer entry points the module has.
+    # Heuristic-aware detect_minis (this file) is run with both heuristics.
+    frame = sequence[0]
+    h, w = frame.shape[:2]
+    # The older variants apply their limits in frame pixels, so this file's
+    # are too, or the rows would compare different filters
+    scale = (1.0, 1.0)
+    candidates = find_edge_contours(to_gray(frame))
+    results = []
+
+    def record(stage, timing, **extra):
+        results.append(dict(variant=name, stage=stage, resolution=f"{w}x{h}", **timing, **extra))
+
+    if hasattr(module, 'select_mini_shapes'):
+        buffer_pool = FrameBufferPool()
+        for heuristic in MINI_SHAPE_HEURISTICS:
+            found = len(module.detect_minis(frame, buffer_pool, scale, heuristic=heuristic))
+            record('detect_minis', time_call(lambda: module.detect_minis(frame, buffer_pool, scale, heuristic=heuristic), iterations),
+                   heuristic=heuristic, found=found, expected=len(bboxes[0]))
+            record('is_mini_shape', time_call(lambda: module.select_mini_shapes(candidates, heuristic, scale[0] * scale[1]), iterations),
+                   heuristic=heuristic, candidates=len(candidates))
+        detections = [module.detect_minis(f, buffer_pool, scale) for f in sequence]
+    elif hasattr(module, 'detect_minis'):
+        found = len(module.detect_minis(frame))
+        record('detect_minis', time_call(lambda: module.detect_minis(frame), iterations), found=found, expected=len(bboxes[0]))
+        record('is_mini_shape', time_call(lambda: [module.is_mini_shape(c) for c in candidates], iterations), candidates=len(candidates))
+        detections = [module.detect_minis(f) for f in sequence]
+    elif hasattr(module, 'detect_objects'):
+        record('detect_objects', time_call(lambda: module.detect_objects(frame), iterations))
+
+    if hasattr(module, 'SmoothDetector') and hasattr(module, 'detect_minis'):
+        smooth_detector = module.SmoothDetector()
+        for contours in detections:
+            smooth_detector.update(contours)
+        record('get_stable_contours', time_call(smooth_detector.get_stable_contours, iterations),
+               contours=len(detections[-1]))
+
+    if hasattr(module, 'draw_pretty_object'):
+        canvas = frame.copy()
+        def draw_all():
+            for index, bbox in enumerate(bboxes[0]):
+                module.draw_pretty_object(canvas, f"mini {index}", bbox, module.get_object_color(f"mini {index}"))
+        record('draw_pretty_object', time_call(draw_all, iterations), objects=len(bboxes[0]))
+    return results
+
+@contextlib.contextmanager
+def camera_stubs():
+    # The older variants import picamera2 (and libcamera) at module level but
+    # only use them in main(), so off the Pi empty stand-ins let them import
+    # for benchmarking. Yields the names that were stubbed.
+    stubbed = []
+    for name in ('picamera2', 'libcamera'):
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            stub = types.ModuleType(name)
+            stub.Picamera2 = None
+            sys.modules[name] = stub
+            stubbed.append(name)
+    try:
+        yield stubbed
+    finally:
+        for name in stubbed:
+            del sys.modules[name]
+
+def benchmark_suite(output_path="benchmark.json", resolutions=((640, 360), (1280, 720), (1920, 1080)),
+                    minis=12, noise=3.0, motion=2.0, frames=10, iterations=20):
+    # Times this file's pipeline stages, and those of every mini_test_*
+    # variant that imports here, on the same synthetic battle maps, and writes
+    # one JSON record per (variant, stage, resolution) so runs can be diffed.
+    variants = {'mini_test_10': sys.modules[__name__]}
+    skipped = {}
+    with camera_stubs() as stubbed:
+        for number in range(1, 10):
+            name = f"mini_test_{number}"
+            try:
+                variants[name] = importlib.import_module(name)
+            except ImportError as e:
+                skipped[name] = str(e)
+
+    results = []
+    for size in resolutions:
+        sequence, bboxes = synthetic_battle_map(size, minis, noise, motion, frames)
+        for name, module in variants.items():
+            results.extend(benchmark_module(name, module, sequence, bboxes, iterations))
+
+        # The default tracker (KCF on contrib builds) on the luma, the way the
+        # live pipeline feeds it
+        tracking_frames = [tracking_input(to_gray(frame)) for frame in sequence]
+        trackers = []
+        for bbox in bboxes[0]:
+            tracker = create_tracker(DEFAULT_BACKEND)
+            tracker.init(tracking_frames[0], bbox)
+            trackers.append(tracker)
+        frame_index = [0]
+        def update_all():
+            # One frame's worth of updates, cycling through the sequence
+            frame_index[0] = frame_index[0] % (frames - 1) + 1
+            for tracker in trackers:
+                tracker.update(tracking_frames[frame_index[0]])
+        timing = time_call(update_all, iterations)
+        results.append(dict(variant='mini_test_10', stage=f'{DEFAULT_BACKEND}_update', resolution=f"{size[0]}x{size[1]}", **timing, objects=len(trackers)))
+
+    for record in results:
+        print(f"{record['variant']:>13} {record['resolution']:>10} {record['stage']:<20} {record.get('heuristic', ''):<8} {record['median_ms']:8.2f} ms")
+
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'parameters': {'minis': minis, 'noise': noise, 'motion': motion, 'frames': frames, 'iterations': iterations},
+        'skipped_variants': skipped,
+        'stubbed_modules': stubbed,
+        'results': results,
+    }
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(results)} results to {output_path}")
+    return report
+
+def linear_assignment(cost):
+    # Minimum-cost one-to-one assignment (Hungarian algorithm, O(n^3)) for a
+    # rectangular cost matrix. Returns the matched (row, column) pairs.
+    cost = np.asarray(cost, float)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    rows, cols = cost.shape
+    if rows == 0:
+        return []
+    u = np.zeros(rows + 1)
+    v = np.zeros(cols + 1)
+    assigned_row = np.zeros(cols + 1, int)  # 1-based row per column, 0 = free
+    way = np.zeros(cols + 1, int)
+    for row in range(1, rows + 1):
+        assigned_row[0] = row
+        col = 0
+        min_slack = np.full(cols + 1, np.inf)
+        used = np.zeros(cols + 1, bool)
+        while True:
+            used[col] = True
+            current_row = assigned_row[col]
+            free = ~used
+            free[0] = False
+            slack = cost[current_row - 1] - u[current_row] - v[1:]
+            better = free[1:] & (slack < min_slack[1:])
+            min_slack[1:][better] = slack[better]
+            way[1:][better] = col
+            candidates = np.where(free, min_slack, np.inf)
+            next_col = int(np.argmin(candidates))
+            delta = candidates[next_col]
+            u[assigned_row[used]] += delta
+            v[used] -= delta
+            min_slack[free] -= delta
+            col = next_col
+            if assigned_row[col] == 0:
+                break
+        while col:
+            previous = way[col]
+            assigned_row[col] = assigned_row[previous]
+            col = previous
+    pairs = [(int(assigned_row[col]) - 1, col - 1) for col in range(1, cols + 1) if assigned_row[col]]
+    if transposed:
+        pairs = [(col, row) for row, col in pairs]
+    return sorted(pairs)
+
+def bbox_iou_matrix(boxes_a, boxes_b):
+    # IoU between every (x, y, w, h) box in boxes_a and every one in boxes_b
+    a = np.asarray(boxes_a, float).reshape(-1, 1, 4)
+    b = np.asarray(boxes_b, float).reshape(1, -1, 4)
+    overlap_w = np.clip(np.minimum(a[..., 0] + a[..., 2], b[..., 0] + b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None)
+    overlap_h = np.clip(np.minimum(a[..., 1] + a[..., 3], b[..., 1] + b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None)
+    intersection = overlap_w * overlap_h
+    union = a[..., 2] * a[..., 3] + b[..., 2] * b[..., 3] - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1e-9), 0.0)
+
+def associate_boxes(track_boxes, detection_boxes, min_iou=0.1, max_distance=60):
+    # Optimal track/detection matching on IoU plus centroid distance. A pair is
+    # only allowed if the boxes overlap by min_iou or their centers are within
+    # max_distance pixels.
+    if len(track_boxes) == 0 or len(detection_boxes) == 0:
+        return []
+    tracks = np.asarray(track_boxes, float).reshape(-1, 4)
+    detections = np.asarray(detection_boxes, float).reshape(-1, 4)
+    iou = bbox_iou_matrix(tracks, detections)
+    track_centers = tracks[:, :2] + tracks[:, 2:] / 2
+    detection_centers = detections[:, :2] + detections[:, 2:] / 2
+    distance = np.linalg.norm(track_centers[:, None, :] - detection_centers[None, :, :], axis=2)
+    allowed = (iou >= min_iou) | (distance <= max_distance)
+    cost = np.where(allowed, (1 - iou) + distance / max_distance, 1e6)
+    return [(t, d) for t, d in linear_assignment(cost) if allowed[t, d]]
+
+class DetectTrackHybrid:
+    # Tracks the whole table without manual seeding: detection runs every
+    # detect_interval frames (or straight away when a track is lost), stable
+    # detections are matched to tracks by optimal assignment, and the cheap
+    # trackers carry the frames in between. Unmatched detections become new
+    # tracks, drifted tracks are re-seeded on their detection, and tracks
+    # whose tracker has lost them and that had no detection for max_misses
+    # rounds are dropped.
+    def __init__(self, tracker, detector, detect_interval=15, max_misses=3, reseed_iou=0.5, backend=DEFAULT_BACKEND, match_radius=40):
+        self.tracker = tracker
+        self.detector = detector
+        # Its own smoother, fed once per detection: a mini moves up to
+        # detect_interval frames' worth between two of its history entries,
+        # so the per-frame match_radius is widened to match
+        self.smooth_detector = SmoothDetector(match_radius=match_radius * detect_interval)
+        self.detect_interval = detect_interval
+        self.max_misses = max_misses
+        self.reseed_iou = reseed_iou
+        self.backend = backend
+        self.enabled = False
+        self.frames_since_detection = detect_interval
+        self.frames = 0
+        self.detections_run = 0
+        self.tracks_created = 0
+        self.tracks_removed = 0
+
+    def step(self, tracking_frame, tracker_frame, buffer_pool, scale):
+        # Returns (object, success, bbox in tracking-frame pixels) per track
+        updates = self.tracker.update_all(tracker_frame)
+        self.frames += 1
+        self.frames_since_detection += 1
+        lost = any(not success for _, success, _ in updates)
+        if self.frames_since_detection >= self.detect_interval or lost:
+            updates = self.redetect(tracking_frame, tracker_frame, buffer_pool, scale, updates)
+        return updates
+
+    def redetect(self, tracking_frame, tracker_frame, buffer_pool, scale, updates):
+        self.frames_since_detection = 0
+        self.detections_run += 1
+        self.smooth_detector.update(self.detector.detect(tracking_frame, buffer_pool, scale))
+        detections = [cv2.boundingRect(contour) for contour in self.smooth_detector.get_stable_contours()]
+
+        # Matching happens in main-stream pixels, where bbox and detections live
+        results = {obj['id']: (obj, success, bbox) for obj, success, bbox in updates}
+        track_ids, track_boxes = self.tracker.bbox_snapshot()
+        tracks = [self.tracker.get(object_id) for object_id in track_ids.tolist()]
+        to_tracking = (1 / scale[0], 1 / scale[1])
+        pairs = associate_boxes(track_boxes, detections)
+        matched_tracks = {t for t, _ in pairs}
+        matched_detections = {d for _, d in pairs}
+
+        for t, d in pairs:
+            obj = tracks[t]
+            obj['misses'] = 0
+            _, success, _ = results.get(obj['id'], (obj, True, None))
+            if not success or bbox_iou_matrix(track_boxes[t], [detections[d]])[0, 0] < self.reseed_iou:
+                track_bbox = scale_bbox(detections[d], to_tracking)
+                if self.tracker.reseed(obj, tracker_frame, track_bbox):
+                    results[obj['id']] = (obj, True, track_bbox)
+
+        for t, obj in enumerate(tracks):
+            if t in matched_tracks:
+                continue
+            obj['misses'] = obj.get('misses', 0) + 1
+            # Detection can miss a mini its tracker still follows
+            _, success, _ = results.get(obj['id'], (obj, True, None))
+            if obj['misses'] > self.max_misses and not success:
+                self.tracker.remove_object(obj['id'])
+                results.pop(obj['id'], None)
+                self.tracks_removed += 1
+
+        for d, detection in enumerate(detections):
+            if d in matched_detections:
+                continue
+            x, y, w, h = detection
+            obj = self.tracker.add_object(x + w // 2, y + h // 2, f"Mini {self.tracker.current_id}", self.backend)
+            track_bbox = scale_bbox(detection, to_tracking)
+            try:
+                self.tracker.init_object(obj, tracker_frame, track_bbox)
+            except cv2.error:
+                self.tracker.remove_object(obj['id'])
+                continue
+            self.tracker.set_bbox(obj, detection)
+            obj['misses'] = 0
+            results[obj['id']] = (obj, True, track_bbox)
+            self.tracks_created += 1
+
+        return list(results.values())
+
+    def stats(self):
+        return {
+            'tracks': len(self.tracker.tracked_objects()),
+            'detection_fraction': self.detections_run / self.frames if self.frames else 0.0,
+            'tracks_created': self.tracks_created,
+            'tracks_removed': self.tracks_removed,
+        }
+
+def draw_detected_minis(frame, contours, scale=(1.0, 1.0)):
+    # scale maps the contours' pixels onto frame's
+    for contour in contours:
+        if scale != (1.0, 1.0):
+            contour = scale_contour(contour, scale)
+        # Draw the detailed contour
+        cv2.drawContours(frame, [contour], 0, (0, 255, 0), 2)
+
+        # Draw the convex hull
+        hull = cv2.convexHull(contour)
+        cv2.drawContours(frame, [hull], 0, (255, 0, 0), 1)
+
+        # Draw the center point of the mini
+        M = cv2.moments(contour)
+        if M["m00"] != 0:
+            cX = int(M["m10"] / M["m00"])
+            cY = int(M["m01"] / M["m00"])
+            cv2.circle(frame, (cX, cY), 3, (0, 0, 255), -1)
+
+def hu_signature(contour, eps=1e-5):
+    # The per-contour half of cv2.matchShapes(..., 1, 0.0): the log-scaled Hu
+    # moments that method I1 compares, plus which of them are big enough to use
+    hu = cv2.HuMoments(cv2.moments(contour)).ravel()
+    valid = np.abs(hu) > eps
+    log_hu = np.zeros(7)
+    log_hu[valid] = 1.0 / (np.sign(hu[valid]) * np.log10(np.abs(hu[valid])))
+    return log_hu, valid
+
+def signature_distances(log_a, valid_a, log_b, valid_b):
+    # matchShapes method I1 between row pairs of two signature arrays
+    both = valid_a & valid_b
+    distances = np.where(both, np.abs(log_a - log_b), 0.0).sum(axis=1)
+    # matchShapes gives up when only one of the two has usable moments
+    distances[valid_a.any(axis=1) != valid_b.any(axis=1)] = np.inf
+    return distances
+
+class SmoothDetector:
+    # Each history frame keeps its contours' centroids and Hu signatures in
+    # arrays, plus a grid keyed by centroid. A contour is only compared against
+    # past contours within match_radius of it, and all of those comparisons
+    # are done as one vectorized distance computation per frame.
+    def __init__(self, history_length=5, match_radius=40, threshold=0.9):
+        self.history = []
+        self.history_length = history_length
+        self.match_radius = match_radius
+        self.threshold = threshold
+        # Last result handed out, reused on frames where smoothing is skipped
+        self.stable_contours = []
+
+    def update(self, contours):
+        centroids = np.zeros((len(contours), 2))
+        log_hu = np.zeros((len(contours), 7))
+        valid = np.zeros((len(contours), 7), bool)
+        grid = {}
+        for index, contour in enumerate(contours):
+            x, y, w, h = cv2.boundingRect(contour)
+            centroids[index] = (x + w / 2, y + h / 2)
+            log_hu[index], valid[index] = hu_signature(contour)
+            grid.setdefault(self.cell_of(*centroids[index]), []).append(index)
+        self.history.append({'contours': contours, 'centroids': centroids, 'log_hu': log_hu, 'valid': valid, 'grid': grid})
+        if len(self.history) > self.history_length:
+            self.history.pop(0)
+
+    def cell_of(self, cx, cy):
+        return (int(cx // self.match_radius), int(cy // self.match_radius))
+
+    def nearby(self, frame, cx, cy):
+        col, row = self.cell_of(cx, cy)
+        for cell_col in (col - 1, col, col + 1):
+            for cell_row in (row - 1, row, row + 1):
+                yield from frame['grid'].get((cell_col, cell_row), ())
+
+    def get_stable_contours(self):
+        if not self.history:
+            return []
+
+        latest = self.history[-1]
+        current, past, frame_of_pair = [], [], []
+        offset = 0
+        for frame_index, frame in enumerate(self.history):
+            for index, (cx, cy) in enumerate(latest['centroids']):
+                for past_index in self.nearby(frame, cx, cy):
+                    current.append(index)
+                    past.append(offset + past_index)
+                    frame_of_pair.append(frame_index)
+            offset += len(frame['contours'])
+        if not current:
+            return []
+
+        current = np.array(current)
+        past = np.array(past)
+        frame_of_pair = np.array(frame_of_pair)
+        past_centroids = np.concatenate([frame['centroids'] for frame in self.history])
+        past_log_hu = np.concatenate([frame['log_hu'] for frame in self.history])
+        past_valid = np.concatenate([frame['valid'] for frame in self.history])
+
+        # Grid cells only bound the search; the radius itself is checked here
+        in_radius = ((latest['centroids'][current] - past_centroids[past]) ** 2).sum(axis=1) <= self.match_radius ** 2
+        distances = signature_distances(latest['log_hu'][current], latest['valid'][current], past_log_hu[past], past_valid[past])
+        similar = in_radius & (distances < self.threshold)
+
+        # A contour counts once per history frame that has any similar match
+        matched = np.zeros((len(latest['contours']), len(self.history)), bool)
+        matched[current[similar], frame_of_pair[similar]] = True
+        counts = matched.sum(axis=1)
+        return [contour for contour, count in zip(latest['contours'], counts) if count >= self.history_length // 2]
+
+class SensorZoom:
+    # Zooms by moving the ISP ScalerCrop window instead of cropping and
+    # upscaling in software. The control is applied live between frames, so
+    # the stream is never reconfigured and the output size stays the same.
+    def __init__(self, picam2):
+        self.picam2 = picam2
+        self.full_crop = tuple(picam2.camera_properties['ScalerCropMaximum'])
+        self.zoom = 1.0
+
+    def crop_for(self, zoom):
+        x, y, w, h = self.full_crop
+        crop_w, crop_h = int(w / zoom), int(h / zoom)
+        return (x + (w - crop_w) // 2, y + (h - crop_h) // 2, crop_w, crop_h)
+
+    def apply(self, zoom):
+        zoom = max(1.0, zoom)  # Can't see more than the whole sensor
+        if zoom != self.zoom:
+            self.picam2.set_controls({"ScalerCrop": self.crop_for(zoom)})
+            self.zoom = zoom
+
+    def capture(self, zoom, lores_size=None):
+        self.apply(zoom)
+        # The crop actually used for a frame arrives in its metadata, which can
+        # lag the request by a few frames, so read it per frame
+        frame, luma, scaler_crop = capture_frames(self.picam2, lores_size)
+        if scaler_crop is None:
+            scaler_crop = self.crop_for(self.zoom)
+        return frame, luma, tuple(scaler_crop)
+
+def capture_frames(picam2, lores_size=None):
+    # Main and lores come from the same request, so they show the same instant.
+    # The lores stream is YUV420; its first rows are the Y plane, which is
+    # what detection and tracking want, so no color conversion is needed.
+    request = picam2.capture_request()
+    try:
+        frame = request.make_array("main")
+        luma = None
+        if lores_size is not None:
+            luma = request.make_array("lores")[:lores_size[1], :lores_size[0]]
+        scaler_crop = request.get_metadata().get("ScalerCrop")
+    finally:
+        request.release()
+    return frame, luma, scaler_crop
+
+def software_zoom(image, zoom, dst):
+    h, w = image.shape[:2]
+    zoom_h, zoom_w = int(h / zoom), int(w / zoom)
+    start_y, start_x = (h - zoom_h) // 2, (w - zoom_w) // 2
+    crop = image[start_y:start_y+zoom_h, start_x:start_x+zoom_w]
+    return cv2.resize(crop, (w, h), dst=dst), (start_x, start_y, zoom_w, zoom_h)
+
+def bbox_to_sensor(bbox, scaler_crop, frame_size):
+    # Map a bbox from output-frame pixels back into the space the crop was
+    # taken from (full-sensor pixels for SensorZoom)
+    x, y, w, h = bbox
+    crop_x, crop_y, crop_w, crop_h = scaler_crop
+    scale_x = crop_w / frame_size[0]
+    scale_y = crop_h / frame_size[1]
+    return (int(crop_x + x * scale_x), int(crop_y + y * scale_y), int(w * scale_x), int(h * scale_y))
+
+def lores_luma(frame, lores_size):
+    # Sources without a lores stream get the same small Y plane made in
+    # software, so detection and tracking see what they would on the Pi
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, lores_size, interpolation=cv2.INTER_AREA)
+
+class FramePacer:
+    # Holds a source to its nominal frame rate, or lets it run as fast as the
+    # pipeline takes frames when free_running
+    def __init__(self, fps, free_running=False):
+        self.period = 1.0 / fps
+        self.free_running = free_running
+        self.next_time = None
+
+    def wait(self):
+        if self.free_running:
+            return
+        now = time.perf_counter()
+        if self.next_time is None or now - self.next_time > self.period:
+            self.next_time = now  # Don't try to catch up after a stall
+        elif self.next_time > now:
+            time.sleep(self.next_time - now)
+        self.next_time += self.period
+
+# Every frame source has read(zoom), returning (frame, luma, scaler_crop) or
+# None at the end of the stream, set_autofocus(enabled), returning whether the
+# source has autofocus at all, and close(). lossless sources want every frame
+# processed rather than only the newest.
+
+class PicameraSource:
+    def __init__(self, main_size=(1920, 1080), lores_size=(640, 360)):
+        if Picamera2 is None:
+            raise RuntimeError("picamera2 is not installed; use a camera, replay or synthetic source")
+        self.lores_size = lores_size
+        self.lossless = False
+        self.picam2 = Picamera2()
+
+        # The lores stream feeds detection and tracking, main is for display
+        config = self.picam2.create_preview_configuration(
+            main={"format": 'XRGB8888', "size": main_size},
+            lores={"format": 'YUV420', "size": lores_size})
+        self.picam2.configure(config)
+
+        self.picam2.set_controls({"AfMode": 2})  # Enable continuous autofocus
+
+        self.picam2.start()
+
+        time.sleep(2)  # Wait for the camera to warm up
+
+        # Prefer zooming on the ISP; fall back to a software crop if the
+        # camera doesn't report a ScalerCrop range
+        self.sensor_zoom = None
+        if 'ScalerCropMaximum' in self.picam2.camera_properties:
+            self.sensor_zoom = SensorZoom(self.picam2)
+
+    def read(self, zoom=1.0):
+        if self.sensor_zoom is not None:
+            return self.sensor_zoom.capture(zoom, self.lores_size)
+        return capture_frames(self.picam2, self.lores_size)[:2] + (None,)
+
+    def set_autofocus(self, enabled):
+        self.picam2.set_controls({"AfMode": 2 if enabled else 0})  # Continuous or manual focus
+        return True
+
+    def close(self):
+        self.picam2.stop()
+
+class VideoCaptureSource:
+    # A USB webcam or anything else cv2.VideoCapture can open
+    def __init__(self, device=0, size=(1920, 1080), lores_size=(640, 360)):
+        self.capture = cv2.VideoCapture(device)
+        if not self.capture.isOpened():
+            raise RuntimeError(f"Could not open video device {device}")
+        self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, size[0])
+        self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, size[1])
+        self.lores_size = lores_size
+        self.lossless = False
+
+    def read(self, zoom=1.0):
+        ok, frame = self.capture.read()
+        if not ok:
+            return None
+        return frame, lores_luma(frame, self.lores_size), None
+
+    def set_autofocus(self, enabled):
+        return bool(self.capture.set(cv2.CAP_PROP_AUTOFOCUS, 1 if enabled else 0))
+
+    def close(self):
+        self.capture.release()
+
+REPLAY_IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+
+class ReplaySource:
+    # Replays a recorded video file or a directory of frames (in file name
+    # order) at its own frame rate, or as fast as the pipeline can take them
+    # when free_running, which is how to measure maximum throughput.
+    def __init__(self, path, free_running=False, fps=None, loop=False, lores_size=(640, 360)):
+        self.lores_size = lores_size
+        self.lossless = free_running
+        self.loop = loop
+        self.frames_read = 0
+        if os.path.isdir(path):
+            self.paths = sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if name.lower().endswith(REPLAY_IMAGE_EXTENSIONS))
+            if not self.paths:
+                raise RuntimeError(f"No images in {path}")
+            self.capture = None
+            self.index = 0
+        else:
+            self.capture = cv2.VideoCapture(path)
+            if not self.capture.isOpened():
+                raise RuntimeError(f"Could not open {path}")
+            fps = fps or self.capture.get(cv2.CAP_PROP_FPS)
+        self.pacer = FramePacer(fps or 30.0, free_running)
+
+    def next_frame(self):
+        if self.capture is None:
+            if self.index == len(self.paths):
+                if not self.loop:
+                    return None
+                self.index = 0
+            frame = cv2.imread(self.paths[self.index])
+            self.index += 1
+            return frame
+        ok, frame = self.capture.read()
+        if not ok and self.loop:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, frame = self.capture.read()
+        return frame if ok else None
+
+    def read(self, zoom=1.0):
+        frame = self.next_frame()
+        if frame is None:
+            return None
+        self.pacer.wait()
+        self.frames_read += 1
+        return frame, lores_luma(frame, self.lores_size), None
+
+    def set_autofocus(self, enabled):
+        return False
+
+    def close(self):
+        if self.capture is not None:
+            self.capture.release()
+
+class SyntheticSource:
+    # Endless synthetic battle map for load testing without a camera. A loop
+    # of frames is rendered up front so generating them costs nothing later.
+    def __init__(self, size=(1920, 1080), minis=12, noise=3.0, motion=1.0, frames=60, fps=30.0, free_running=False, lores_size=(640, 360)):
+        self.frames, _ = synthetic_battle_map(size, minis, noise, motion, frames)
+        self.lumas = [lores_luma(frame, lores_size) for frame in self.frames]
+        self.lores_size = lores_size
+        self.lossless = free_running
+        self.pacer = FramePacer(fps, free_running)
+        self.index = 0
+
+    def read(self, zoom=1.0):
+        self.pacer.wait()
+        index = self.index % len(self.frames)
+        self.index += 1
+        return self.frames[index], self.lumas[index], None
+
+    def set_autofocus(self, enabled):
+        return False
+
+    def close(self):
+        pass
+
+FRAME_SOURCES = {
+    'picamera': PicameraSource,
+    'camera': VideoCaptureSource,
+    'replay': ReplaySource,
+    'synthetic': SyntheticSource,
+}
+
+def frame_source_from_args(args):
+    # picamera | camera [device] | replay <video or image dir> [fast] | synthetic [fast]
+    kind = args[0] if args else 'picamera'
+    free_running = 'fast' in args[1:]
+    if kind == 'camera':
+        device = args[1] if len(args) > 1 else '0'
+        return VideoCaptureSource(int(device) if device.isdigit() else device)
+    if kind == 'replay':
+        return ReplaySource(args[1], free_running)
+    if kind == 'synthetic':
+        return SyntheticSource(free_running=free_running)
+    return FRAME_SOURCES[kind]()
+
+class FrameRing:
+    # Bounded hand-off between two pipeline stages. When the consumer falls
+    # behind, the oldest frame is dropped so the newest one is always next.
+    def __init__(self, capacity=2):
+        self.frames = collections.deque(maxlen=capacity)
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, frame, wait=False):
+        # With wait, blocks for a free slot instead of dropping the oldest
+        with self.condition:
+            while wait and len(self.frames) == self.frames.maxlen and not self.closed:
+                self.condition.wait(0.1)
+            if len(self.frames) == self.frames.maxlen:
+                self.dropped += 1
+            self.frames.append(frame)
+            self.condition.notify_all()
+
+    def get(self, timeout=None):
+        with self.condition:
+            if not self.frames and not self.closed:
+                self.condition.wait(timeout)
+            if not self.frames:
+                return None
+            frame = self.frames.popleft()
+            self.condition.notify_all()
+            return frame
+
+    def get_latest(self, timeout=None):
+        # Like get, but skips straight to the newest frame and drops the rest
+        with self.condition:
+            if not self.frames and not self.closed:
+                self.condition.wait(timeout)
+            if not self.frames:
+                return None
+            self.dropped += len(self.frames) - 1
+            frame = self.frames.pop()
+            self.frames.clear()
+            self.condition.notify_all()
+            return frame
+
+    def depth(self):
+        return len(self.frames)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class StageProfiler:
+    # Rolling per-stage timings from every pipeline thread. Each sample is one
+    # deque append; percentiles are only computed when asked for. While a
+    # trace is being recorded every sample is also kept as a Chrome trace event
+    # (load the dump in chrome://tracing or Perfetto).
+    def __init__(self, window=300, max_trace_events=200000):
+        self.window = window
+        self.samples = {}
+        self.epoch = time.perf_counter()
+        self.trace_events = None
+        self.max_trace_events = max_trace_events
+        self.thread_names = {}
+        self.overlay = False
+
+    def record(self, name, start, end):
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples.setdefault(name, collections.deque(maxlen=self.window))
+        samples.append(end - start)
+        if self.trace_events is not None and len(self.trace_events) < self.max_trace_events:
+            thread = threading.current_thread()
+            self.thread_names[thread.ident] = thread.name
+            self.trace_events.append((name, start, end - start, thread.ident))
+
+    def percentiles(self):
+        # {stage: (p50, p95, p99)} in milliseconds
+        summary = {}
+        for name, samples in list(self.samples.items()):
+            if samples:
+                summary[name] = tuple(np.percentile(np.array(samples) * 1000, (50, 95, 99)))
+        return summary
+
+    def start_trace(self):
+        self.trace_events = []
+
+    def tracing(self):
+        return self.trace_events is not None
+
+    def stop_trace(self, path):
+        # Writes the recorded spans as Chrome trace events and stops recording
+        events, self.trace_events = self.trace_events or [], None
+        pid = multiprocessing.current_process().pid
+        trace = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                 for tid, name in self.thread_names.items()]
+        trace += [{'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                   'ts': (start - self.epoch) * 1e6, 'dur': duration * 1e6}
+                  for name, start, duration, tid in events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+        return len(events)
+
+    def draw_overlay(self, frame):
+        lines = [f"{name:<10} p50 {p50:6.2f}  p95 {p95:6.2f}  p99 {p99:6.2f} ms"
+                 for name, (p50, p95, p99) in sorted(self.percentiles().items())]
+        if not lines:
+            return
+        height = 16 * len(lines) + 8
+        width = min(frame.shape[1], 400)
+        region = frame[:height, :width]
+        region //= 3
+        for i, line in enumerate(lines):
+            cv2.putText(frame, line, (6, 16 * i + 16), cv2.FONT_HERSHEY_PLAIN, 1.0, (255, 255, 255), 1)
+
+def print_profile(percentiles):
+    for name, (p50, p95, p99) in sorted(percentiles.items()):
+        print(f"Stage {name}: p50 {p50:.2f} ms, p95 {p95:.2f} ms, p99 {p99:.2f} ms")
+
+class FrameScheduler:
+    # Holds processing to a target frame period. Every stage is timed over a
+    # rolling window; optional stages (detection, smoothing, particles) are
+    # skipped when their recent cost, plus that of the required stages still
+    # to come, doesn't fit in what is left of the frame. No stage is skipped
+    # more than max_skips frames in a row, so a slow frame decimates the
+    # optional work instead of starving it.
+    def __init__(self, target_fps=30.0, max_skips=4, window=30, profiler=None):
+        self.period = 1.0 / target_fps
+        # Optional StageProfiler that also receives every timed stage
+        self.profiler = profiler
+        self.max_skips = max_skips
+        self.window = window
+        self.stage_times = {}
+        self.skipped = {}
+        self.consecutive_skips = {}
+        self.frame_starts = collections.deque(maxlen=window)
+        self.frame_start = None
+        self.frames = 0
+        self.misses = 0
+
+    def set_target_fps(self, fps):
+        self.period = 1.0 / fps
+
+    def begin_frame(self):
+        self.frame_start = time.perf_counter()
+        self.frame_starts.append(self.frame_start)
+
+    def average(self, name):
+        times = self.stage_times.get(name)
+        return sum(times) / len(times) if times else 0.0
+
+    def due(self, name, reserve=()):
+        # reserve names the required stages that still have to run this frame
+        remaining = self.frame_start + self.period - time.perf_counter()
+        needed = self.average(name) + sum(self.average(stage) for stage in reserve)
+        if needed <= remaining or self.consecutive_skips.get(name, 0) >= self.max_skips:
+            self.consecutive_skips[name] = 0
+            return True
+        self.consecutive_skips[name] = self.consecutive_skips.get(name, 0) + 1
+        self.skipped[name] = self.skipped.get(name, 0) + 1
+        return False
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            times = self.stage_times.setdefault(name, collections.deque(maxlen=self.window))
+            times.append(end - start)
+            if self.profiler is not None:
+                self.profiler.record(name, start, end)
+
+    def end_frame(self):
+        self.frames += 1
+        if time.perf_counter() - self.frame_start > self.period:
+            self.misses += 1
+
+    def stats(self):
+        starts = self.frame_starts
+        span = starts[-1] - starts[0] if len(starts) > 1 else 0.0
+        return {
+            'target_fps': 1.0 / self.period,
+            'achieved_fps': (len(starts) - 1) / span if span > 0 else 0.0,
+            'deadline_misses': self.misses,
+            'frames_scheduled': self.frames,
+            'skipped_stages': dict(self.skipped),
+            'stage_ms': {name: self.average(name) * 1000 for name in self.stage_times},
+        }
+
+# Output sinks take the annotated full-size frame when running headless. They
+# write on the processing thread, before the frame's buffer is reused.
+
+class NullSink:
+    def write(self, frame):
+        pass
+
+    def close(self):
+        pass
+
+class VideoFileSink:
+    def __init__(self, path, fps=30.0):
+        self.path = path
+        self.fps = fps
+        self.writer = None
+
+    def write(self, frame):
+        if self.writer is None:
+            # Opened on the first frame, once the output size is known
+            fourcc = cv2.VideoWriter_fourcc(*('mp4v' if self.path.lower().endswith('.mp4') else 'MJPG'))
+            h, w = frame.shape[:2]
+            self.writer = cv2.VideoWriter(self.path, fourcc, self.fps, (w, h))
+            if not self.writer.isOpened():
+                raise RuntimeError(f"Could not open {self.path} for writing")
+        self.writer.write(frame)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.release()
+
+class SnapshotSink:
+    # Writes a JPEG of the next frame each time one is requested
+    def __init__(self, directory=".", quality=90):
+        self.directory = directory
+        self.quality = quality
+        self.requested = threading.Event()
+        self.saved = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def request_snapshot(self):
+        self.requested.set()
+
+    def write(self, frame):
+        if not self.requested.is_set():
+            return
+        self.requested.clear()
+        path = os.path.join(self.directory, f"snapshot_{time.strftime('%Y%m%d_%H%M%S')}_{self.saved:04d}.jpg")
+        if not cv2.imwrite(path, frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality]):
+            # A failed snapshot should not stop the run
+            print(f"Could not write {path}")
+            return
+        self.saved += 1
+        print(f"Saved {path}")
+
+    def close(self):
+        pass
+
+OUTPUT_SINKS = {
+    'none': NullSink,
+    'video': VideoFileSink,
+    'snapshots': SnapshotSink,
+}
+
+def output_sink_from_args(args):
+    # none | video <path> | snapshots [directory]
+    kind = args[0] if args else 'none'
+    return OUTPUT_SINKS[kind](*args[1:2])
+
+# Display ring capacity, plus the frame on screen and the one being written
+DISPLAY_BUFFER_SLOTS = 4
+
+class FramePipeline:
+    # Capture and processing each run on their own thread; the display stage
+    # stays on the main thread because HighGUI has to be driven from there.
+    def __init__(self, capture, process, running, capacity=2, buffer_pool=None, scheduler=None, lossless=False, sink=None):
+        # lossless processes every captured frame, for replays that should be
+        # measured end to end rather than kept live
+        self.lossless = lossless
+        # Headless runs hand processed frames to the sink instead of display
+        self.sink = sink
+        self.capture = capture
+        self.process = process
+        self.running = running
+        self.buffer_pool = buffer_pool
+        self.scheduler = scheduler
+        self.capture_ring = FrameRing(capacity)
+        self.display_ring = FrameRing(capacity)
+        self.stage_counts = {'capture': 0, 'process': 0, 'display': 0}
+        self.threads = []
+        self.start_time = None
+        self.error = None
+
+    def start(self):
+        self.start_time = time.time()
+        for target in (self.capture_loop, self.process_loop):
+            thread = threading.Thread(target=self.guarded, args=(target,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def guarded(self, loop):
+        # A stage that dies would leave the others waiting on it forever, so
+        # any error stops the whole pipeline and main() shuts down
+        try:
+            loop()
+        except Exception as e:
+            self.error = e
+            print(f"An error occurred in {loop.__name__}: {e}")
+            self.running[0] = False
+            self.capture_ring.close()
+            self.display_ring.close()
+
+    def capture_loop(self):
+        while self.running[0]:
+            with self.timed('capture'):
+                frame = self.capture()
+            if frame is None:
+                # End of a replayed stream; processing drains what is queued
+                self.capture_ring.close()
+                break
+            self.stage_counts['capture'] += 1
+            self.capture_ring.put(frame, wait=self.lossless)
+
+    def process_loop(self):
+        while self.running[0]:
+            # Frames that queued up while the last one was processed are stale
+            if self.lossless:
+                frame = self.capture_ring.get(timeout=0.1)
+            else:
+                frame = self.capture_ring.get_latest(timeout=0.1)
+            if frame is None:
+                if self.capture_ring.closed:
+                    self.running[0] = False
+                continue
+            display_frame = self.process(frame)
+            self.stage_counts['process'] += 1
+            if self.sink is None:
+                self.display_ring.put(display_frame)
+                continue
+            if display_frame is None:
+                # Nothing was drawn, so there is nothing to write
+                continue
+            profiler = self.scheduler.profiler if self.scheduler is not None else None
+            if profiler is not None and profiler.overlay:
+                profiler.draw_overlay(display_frame)
+            with self.timed('sink'):
+                self.sink.write(display_frame)
+            self.stage_counts['display'] += 1
+
+    def timed(self, name):
+        if self.scheduler is None:
+            return contextlib.nullcontext()
+        return self.scheduler.timed(name)
+
+    def next_display_frame(self, timeout=0.1):
+        frame = self.display_ring.get(timeout)
+        if frame is not None:
+            self.stage_counts['display'] += 1
+        return frame
+
+    def stats(self):
+        elapsed = max(time.time() - self.start_time, 1e-6) if self.start_time else 1e-6
+        stats = {
+            'capture_fps': self.stage_counts['capture'] / elapsed,
+            'process_fps': self.stage_counts['process'] / elapsed,
+            'display_fps': self.stage_counts['display'] / elapsed,
+            'process_queue_depth': self.capture_ring.depth(),
+            'display_queue_depth': self.display_ring.depth(),
+            'process_queue_dropped': self.capture_ring.dropped,
+            'display_queue_dropped': self.display_ring.dropped,
+        }
+        if self.buffer_pool is not None:
+            stats.update(self.buffer_pool.stats())
+        if self.scheduler is not None:
+            stats.update(self.scheduler.stats())
+        return stats
+
+    def stop(self):
+        self.running[0] = False
+        self.capture_ring.close()
+        self.display_ring.close()
+        for thread in self.threads:
+            thread.join(timeout=1.0)
+
+def print_pipeline_stats(stats):
+    print(f"Capture: {stats['capture_fps']:.1f} fps")
+    print(f"Process: {stats['process_fps']:.1f} fps, queue depth {stats['process_queue_depth']}, dropped {stats['process_queue_dropped']}")
+    print(f"Display: {stats['display_fps']:.1f} fps, queue depth {stats['display_queue_depth']}, dropped {stats['display_queue_dropped']}")
+    if 'bytes_allocated_last_frame' in stats:
+        print(f"Buffers: {stats['bytes_allocated_last_frame']} bytes allocated last frame, {stats['pooled_bytes']} bytes pooled")
+    if 'achieved_fps' in stats:
+        print(f"Schedule: {stats['achieved_fps']:.1f} of {stats['target_fps']:.0f} fps, {stats['deadline_misses']} of {stats['frames_scheduled']} frames over budget")
+        stages = ", ".join(f"{name} {ms:.1f} ms" for name, ms in stats['stage_ms'].items())
+        print(f"Stages: {stages}")
+        if stats['skipped_stages']:
+            skipped = ", ".join(f"{name} {count}" for name, count in stats['skipped_stages'].items())
+            print(f"Skipped: {skipped}")
+
+def print_tracker_stats(summary):
+    for backend, stats in summary.items():
+        print(f"Tracker {backend}: {stats['tracks']} tracks, {stats['updates']} updates, {stats['avg_ms']:.2f} ms/update")
+
+class TrackerControl:
+    # Structured commands from the control server and the menu. execute()
+    # runs on the processing thread between frames, so zoom, tracking and
+    # the object list only ever change at a frame boundary.
+    #   {"command": "start"} / {"command": "stop"}
+    #   {"command": "zoom", "value": 2.0} or {"command": "zoom", "delta": -0.1}
+    #   {"command": "autofocus", "enabled": false}  (toggles without "enabled")
+    #   {"command": "parallel", "workers": 4}  (0 disables, toggles without "workers")
+    #   {"command": "motion", "enabled": true}  (motion-gated tracker updates; toggles without "enabled")
+    #   {"command": "sharded", "workers": 4}  (0 disables, toggles without "workers")
+    #   {"command": "budget", "enabled": true}  (budget-driven backends; toggles without "enabled")
+    #   {"command": "detection", "levels": 2, "incremental": true}  (null cycles levels 0-3 / toggles incremental)
+    #   {"command": "auto", "enabled": true}  (detect-and-track; toggles without "enabled")
+    #   {"command": "fps", "value": 20}
+    #   {"command": "overlay", "enabled": true}  (profiling overlay; toggles without "enabled")
+    #   {"command": "trace", "path": "trace.json"}  (starts a trace, or saves the running one)
+    #   {"command": "add", "bbox": [x, y, w, h], "label": "Goblin"}  (main-stream pixels)
+    #   {"command": "relabel", "id": 3, "label": "Orc"} / {"command": "remove", "id": 3}
+    #   {"command": "snapshot"}  (headless snapshots output only)
+    #   {"command": "stats"} / {"command": "quit"}
+    def __init__(self, tracker, zoom_factor, running, source, pipeline, detector=None, hybrid=None):
+        self.tracker = tracker
+        self.zoom_factor = zoom_factor
+        self.running = running
+        self.source = source
+        self.pipeline = pipeline
+        self.detector = detector
+        self.hybrid = hybrid
+        self.autofocus = True
+
+    def execute(self, request, tracker_frame, scale):
+        try:
+            name = request.get('command')
+            handler = getattr(self, 'do_' + str(name), None)
+            if handler is None:
+                raise ValueError(f"unknown command {name!r}")
+            result = handler(request, tracker_frame, scale)
+        except (ValueError, TypeError, KeyError, cv2.error) as e:
+            return {'ok': False, 'error': str(e)}
+        result['ok'] = True
+        return result
+
+    def do_start(self, request, tracker_frame, scale):
+        self.tracker.tracking = True
+        return {'tracking': True}
+
+    def do_stop(self, request, tracker_frame, scale):
+        self.tracker.tracking = False
+        return {'tracking': False}
+
+    def do_zoom(self, request, tracker_frame, scale):
+        if 'value' in request:
+            zoom = float(request['value'])
+        else:
+            zoom = self.zoom_factor[0] + float(request['delta'])
+        # The sensor can't see more than its full area, so SensorZoom stops
+        # at 1.0; only software zoom can shrink the picture
+        min_zoom = 1.0 if getattr(self.source, 'sensor_zoom', None) is not None else 0.1
+        self.zoom_factor[0] = min(4.0, max(min_zoom, zoom))
+        return {'zoom': self.zoom_factor[0]}
+
+    def do_autofocus(self, request, tracker_frame, scale):
+        enabled = bool(request.get('enabled', not self.autofocus))
+        if not self.source.set_autofocus(enabled):
+            raise ValueError("this frame source has no autofocus")
+        self.autofocus = enabled
+        return {'autofocus': enabled}
+
+    def do_parallel(self, request, tracker_frame, scale):
+        if 'workers' in request:
+            workers = int(request['workers'])
+        else:
+            workers = 0 if self.tracker.executor is not None else 4
+        self.tracker.set_parallel(workers)
+        return {'parallel': workers if self.tracker.executor is not None else 0}
+
+    def do_motion(self, request, tracker_frame, scale):
+        enabled = bool(request.get('enabled', self.tracker.motion_filter is None))
+        if enabled != (self.tracker.motion_filter is not None):
+            self.tracker.set_motion_filter(ConstantVelocityFilter() if enabled else None)
+        return {'motion': enabled}
+
+    def do_sharded(self, request, tracker_frame, scale):
+        if 'workers' in request:
+            workers = int(request['workers'])
+        else:
+            workers = 0 if self.tracker.shard_workers else 4
+        self.tracker.set_sharded(max(workers, 0))
+        return {'sharded': self.tracker.shard_workers}
+
+    def do_budget(self, request, tracker_frame, scale):
+        enabled = bool(request.get('enabled', self.tracker.budget_policy is None))
+        if enabled != (self.tracker.budget_policy is not None):
+            self.tracker.budget_policy = TrackerBudgetPolicy() if enabled else None
+        result = {'budget': enabled}
+        if enabled:
+            result['budget_ms'] = self.tracker.budget_policy.frame_budget * 1000
+        return result
+
+    def do_detection(self, request, tracker_frame, scale):
+        if 'levels' in request:
+            levels = request['levels']
+            self.detector.levels = (self.detector.levels + 1) % 4 if levels is None else min(3, max(0, int(levels)))
+        if 'incremental' in request:
+            incremental = request['incremental']
+            self.detector.enabled = not self.detector.enabled if incremental is None else bool(incremental)
+        return {'levels': self.detector.levels, 'incremental': self.detector.enabled}
+
+    def do_auto(self, request, tracker_frame, scale):
+        self.hybrid.enabled = bool(request.get('enabled', not self.hybrid.enabled))
+        if self.hybrid.enabled:
+            self.tracker.tracking = True
+        return {'auto': self.hybrid.enabled, 'detect_interval': self.hybrid.detect_interval}
+
+    def do_fps(self, request, tracker_frame, scale):
+        fps = float(request['value'])
+        if fps <= 0 or self.pipeline.scheduler is None:
+            raise ValueError("invalid frame rate")
+        self.pipeline.scheduler.set_target_fps(fps)
+        return {'fps': fps}
+
+    def profiler(self):
+        if self.pipeline.scheduler is None or self.pipeline.scheduler.profiler is None:
+            raise ValueError("profiling is not available")
+        return self.pipeline.scheduler.profiler
+
+    def do_overlay(self, request, tracker_frame, scale):
+        profiler = self.profiler()
+        profiler.overlay = bool(request.get('enabled', not profiler.overlay))
+        return {'overlay': profiler.overlay}
+
+    def do_trace(self, request, tracker_frame, scale):
+        profiler = self.profiler()
+        if not profiler.tracing():
+            profiler.start_trace()
+            return {'tracing': True}
+        path = str(request.get('path') or "trace.json")
+        try:
+            count = profiler.stop_trace(path)
+        except OSError as e:
+            raise ValueError(f"could not write {path}: {e}")
+        return {'tracing': False, 'path': path, 'events': count}
+
+    def do_add(self, request, tracker_frame, scale):
+        x, y, w, h = (int(v) for v in request['bbox'])
+        if w <= 0 or h <= 0:
+            raise ValueError("bbox needs a positive width and height")
+        frame_w, frame_h = tracker_frame.shape[1] * scale[0], tracker_frame.shape[0] * scale[1]
+        if x < 0 or y < 0 or x + w > frame_w or y + h > frame_h:
+            raise ValueError(f"bbox must lie inside the {frame_w:.0f}x{frame_h:.0f} frame")
+        obj = place_object(self.tracker, tracker_frame, scale, (x, y, w, h), request.get('label'))
+        return {'id': obj['id'], 'label': obj['label']}
+
+    def do_relabel(self, request, tracker_frame, scale):
+        obj = self.tracker.get(int(request['id']))
+        if obj is None:
+            raise ValueError(f"no object {request['id']}")
+        self.tracker.update_label(obj['id'], str(request['label']))
+        return {'id': obj['id'], 'label': obj['label']}
+
+    def do_remove(self, request, tracker_frame, scale):
+        object_id = int(request['id'])
+        if self.tracker.get(object_id) is None:
+            raise ValueError(f"no object {object_id}")
+        self.tracker.remove_object(object_id)
+        return {'id': object_id}
+
+    def do_snapshot(self, request, tracker_frame, scale):
+        if not hasattr(self.pipeline.sink, 'request_snapshot'):
+            raise ValueError("snapshots need headless mode with the snapshots output")
+        self.pipeline.sink.request_snapshot()
+        return {'snapshot': True}
+
+    def do_stats(self, request, tracker_frame, scale):
+        # sensor_bbox is the last tracked box in full-sensor pixels, which
+        # stays put when the zoom changes
+        objects = [{'id': obj['id'], 'label': obj['label'], 'bbox': [int(v) for v in obj['bbox']] if obj['bbox'] else None,
+                    'sensor_bbox': list(obj['sensor_bbox']) if obj.get('sensor_bbox') else None}
+                   for obj in self.tracker.objects.values()]
+        return {'tracking': self.tracker.tracking, 'zoom': self.zoom_factor[0], 'autofocus': self.autofocus,
+                'objects': objects, 'pipeline': self.pipeline.stats(), 'trackers': self.tracker.backend_summary()}
+
+    def do_quit(self, request, tracker_frame, scale):
+        self.running[0] = False
+        return {}
+
+class ControlServer:
+    # Local HTTP control API, so a phone or tablet can drive the tracker
+    # without the Pi's terminal:
+    #   curl -H 'Content-Type: application/json' -d '{"command": "zoom", "value": 1.5}' http://127.0.0.1:8765/command
+    #   curl http://127.0.0.1:8765/stats
+    # The asyncio loop runs on its own thread and only queues requests; each
+    # response is sent once the processing thread has applied the command.
+    def __init__(self, commands, host='127.0.0.1', port=8765, timeout=2.0):
+        self.commands = commands
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.loop = None
+        self.stopping = None
+        self.error = None
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=lambda: asyncio.run(self.serve()), daemon=True)
+
+    def start(self):
+        # Returns whether the server is listening
+        self.thread.start()
+        self.ready.wait()
+        return self.error is None
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        try:
+            server = await asyncio.start_server(self.handle, self.host, self.port)
+        except OSError as e:
+            self.error = e
+            self.ready.set()
+            return
+        self.ready.set()
+        async with server:
+            await self.stopping.wait()
+
+    def submit(self, request):
+        # Queue a request for the next frame boundary; returns a future
+        # for its result on the server's loop
+        future = self.loop.create_future()
+
+        def deliver(result):
+            if not future.done():
+                future.set_result(result)
+
+        def reply(result):
+            try:
+                self.loop.call_soon_threadsafe(deliver, result)
+            except RuntimeError:
+                pass  # The server has shut down
+        self.commands.put(('control', request, reply))
+        return future
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                key, _, value = line.decode('latin-1').partition(':')
+                headers[key.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', 0))
+            body = await reader.readexactly(length) if length else b''
+            status, result = await self.route(request_line, headers, body)
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            status, result = 400, {'ok': False, 'error': str(e)}
+        payload = json.dumps(result, default=float).encode()
+        writer.write((f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+                      "Content-Type: application/json\r\n"
+                      f"Content-Length: {len(payload)}\r\n"
+                      "Connection: close\r\n\r\n").encode() + payload)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def route(self, request_line, headers, body):
+        if len(request_line) < 2:
+            raise ValueError("malformed request")
+        method, path = request_line[0], request_line[1]
+        if method == 'GET' and path == '/stats':
+            request = {'command': 'stats'}
+        elif method == 'POST' and path == '/command':
+            # A web page can only send a JSON content type after a CORS
+            # preflight, which this server never grants, so requiring it
+            # keeps other sites the operator has open from sending commands
+            if headers.get('content-type', '').split(';')[0].strip().lower() != 'application/json':
+                return 415, {'ok': False, 'error': "expected Content-Type: application/json"}
+            request = json.loads(body or b'{}')
+            if not isinstance(request, dict):
+                raise ValueError("expected a JSON object")
+        else:
+            return 404, {'ok': False, 'error': "use POST /command or GET /stats"}
+        try:
+            result = await asyncio.wait_for(self.submit(request), self.timeout)
+        except asyncio.TimeoutError:
+            return 504, {'ok': False, 'error': "no frame processed in time"}
+        return (200 if result['ok'] else 400), result
+
+    def stop(self):
+        if self.loop is not None and self.stopping is not None:
+            try:
+                self.loop.call_soon_threadsafe(self.stopping.set)
+            except RuntimeError:
+                pass
+        self.thread.join(timeout=1.0)
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 415: 'Unsupported Media Type', 504: 'Gateway Timeout'}
+
+def print_menu():
+    print("\nDnD Mini Tracker Menu:")
+    print("1. Start tracking")
+    print("2. Stop tracking")
+    print("3. Zoom in")
+    print("4. Zoom out")
+    print("5. Toggle autofocus")
+    print("6. Show pipeline stats")
+    print("7. Cycle detection speed/accuracy")
+    print("8. Toggle incremental detection")
+    print("9. Toggle parallel tracking")
+    print("10. Toggle process-sharded tracking")
+    print("11. Toggle budget-driven tracker backends")
+    print("12. Toggle automatic detect-and-track")
+    print("13. Toggle motion-gated tracker updates")
+    print("14. Set target frame rate")
+    print("15. Toggle profiling overlay")
+    print("16. Start/stop trace recording")
+    print("17. Save snapshot (headless snapshot output)")
+    print("18. Quit")
+    print("Enter your choice: ", end="", flush=True)
+
+def control_reply(message):
+    # Menu reply for a queued control command: message formats a success
+    def reply(result):
+        print(message(result) if result['ok'] else result['error'].capitalize())
+    return reply
+
+def handle_input(tracker, commands, running, pipeline, detector, hybrid):
+    # Every setting goes through the command queue like the control server's
+    # requests, so none of them changes in the middle of a frame
+    while running[0]:
+        print_menu()
+        try:
+            choice = input().strip()
+        except EOFError:
+            # No terminal (e.g. a headless service): run without the menu
+            return
+        if choice == '1':
+            commands.put(('control', {'command': 'start'}, control_reply(lambda result: "Tracking started")))
+        elif choice == '2':
+            commands.put(('control', {'command': 'stop'}, control_reply(lambda result: "Tracking stopped")))
+        elif choice == '3':
+            commands.put(('control', {'command': 'zoom', 'delta': 0.1},
+                          control_reply(lambda result: f"Zoomed in. Zoom factor: {result['zoom']:.1f}")))
+        elif choice == '4':
+            commands.put(('control', {'command': 'zoom', 'delta': -0.1},
+                          control_reply(lambda result: f"Zoomed out. Zoom factor: {result['zoom']:.1f}")))
+        elif choice == '5':
+            commands.put(('control', {'command': 'autofocus'},
+                          control_reply(lambda result: f"Autofocus {'enabled' if result['autofocus'] else 'disabled'}")))
+        elif choice == '6':
+            print_pipeline_stats(pipeline.stats())
+            print_tracker_stats(tracker.backend_summary())
+            if tracker.motion_filter is not None:
+                stats = tracker.motion_filter.stats()
+                print(f"Motion gating: {stats['updates']} tracker updates, {stats['skipped']} skipped ({stats['skipped_fraction']:.0%})")
+            if hybrid.enabled:
+                stats = hybrid.stats()
+                print(f"Auto tracking: {stats['tracks']} tracks, detection on {stats['detection_fraction']:.0%} of frames, {stats['tracks_created']} created, {stats['tracks_removed']} removed")
+            if detector.enabled:
+                stats = detector.stats()
+                print(f"Incremental detection: {stats['redetected_tiles']}/{stats['total_tiles']} tiles re-detected last frame, {stats['cached_minis']} minis cached")
+            if pipeline.scheduler is not None and pipeline.scheduler.profiler is not None:
+                print_profile(pipeline.scheduler.profiler.percentiles())
+        elif choice == '7':
+            commands.put(('control', {'command': 'detection', 'levels': None}, control_reply(
+                lambda result: "Detection: full frame (most accurate)" if result['levels'] == 0
+                else f"Detection: coarse-to-fine, {result['levels']} pyramid level(s)")))
+        elif choice == '8':
+            commands.put(('control', {'command': 'detection', 'incremental': None}, control_reply(
+                lambda result: f"Incremental detection {'enabled' if result['incremental'] else 'disabled'}")))
+        elif choice == '9':
+            commands.put(('control', {'command': 'parallel'}, control_reply(
+                lambda result: f"Parallel tracking enabled ({result['parallel']} threads)" if result['parallel'] else "Parallel tracking disabled")))
+        elif choice == '10':
+            commands.put(('control', {'command': 'sharded'}, control_reply(
+                lambda result: f"Sharded tracking enabled ({result['sharded']} processes)" if result['sharded'] else "Sharded tracking disabled")))
+        elif choice == '11':
+            commands.put(('control', {'command': 'budget'}, control_reply(
+                lambda result: f"Tracker backends follow a {result['budget_ms']:.0f} ms tracking budget" if result['budget'] else "Tracker backends fixed")))
+        elif choice == '12':
+            commands.put(('control', {'command': 'auto'}, control_reply(
+                lambda result: f"Automatic tracking: detecting every {result['detect_interval']} frames" if result['auto'] else "Automatic tracking disabled")))
+        elif choice == '13':
+            commands.put(('control', {'command': 'motion'}, control_reply(
+                lambda result: "Trackers only update when a mini moves" if result['motion'] else "Trackers update every frame")))
+        elif choice == '14':
+            try:
+                fps = float(input("Target frames per second: "))
+            except ValueError:
+                fps = 0
+            commands.put(('control', {'command': 'fps', 'value': fps}, control_reply(
+                lambda result: f"Target frame rate: {result['fps']:.0f} fps")))
+        elif choice == '15':
+            commands.put(('control', {'command': 'overlay'}, control_reply(
+                lambda result: f"Profiling overlay {'on' if result['overlay'] else 'off'}")))
+        elif choice == '16':
+            request = {'command': 'trace'}
+            if pipeline.scheduler.profiler.tracing():
+                request['path'] = input("Trace file (default trace.json): ")
+            commands.put(('control', request, control_reply(
+                lambda result: f"Wrote {result['events']} trace events to {result['path']}" if not result['tracing']
+                else "Recording trace; choose 16 again to save it")))
+        elif choice == '17':
+            commands.put(('control', {'command': 'snapshot'}, control_reply(lambda result: "Snapshot requested")))
+        elif choice == '18':
+            commands.put(('control', {'command': 'quit'}, control_reply(lambda result: "Quitting...")))
+        else:
+            print("Invalid choice. Please try again.")
+
+def tracking_input(tracking_frame, buffer_pool=None):
+    # KCF only works on three-channel images, so the luma is replicated into
+    # three channels, which is still far cheaper than converting main
+    if tracking_frame.ndim == 3:
+        return tracking_frame
+    return cv2.cvtColor(tracking_frame, cv2.COLOR_GRAY2BGR, dst=pool_buffer(buffer_pool, 'tracker_input', tracking_frame.shape + (3,)))
+
+def process_frame(captured, tracker, smooth_detector, zoom_factor, commands, buffer_pool, detector, hybrid, scheduler, display_size=(960, 540), overlay=None, annotate=True):
+    # luma is the lores Y plane (None without a lores stream) and scaler_crop
+    # is None unless the sensor already did the zooming. Without a
+    # display_size the annotated frame comes back full size, for headless sinks.
+    # overlay is an optional OverlayLayer that keeps boxes and labels between frames.
+    # Without annotate only detection and tracking run and None comes back.
+    frame, luma, scaler_crop = captured
+    scheduler.begin_frame()
+    buffer_pool.begin_frame()
+    h, w = frame.shape[:2]
+    with scheduler.timed('convert'):
+        rgb = buffer_pool.get('rgb', (h, w, 3))
+        if frame.shape[2] == 4:
+            frame = cv2.cvtColor(frame, cv2.COLOR_RGBA2RGB, dst=rgb)
+        elif annotate:
+            # Sources may hand out the same array again, so never draw on it
+            np.copyto(rgb, frame)
+            frame = rgb
+
+    if scaler_crop is None:
+        scaler_crop = (0, 0, w, h)
+        if zoom_factor[0] != 1.0:
+            with scheduler.timed('zoom'):
+                frame, scaler_crop = software_zoom(frame, zoom_factor[0], buffer_pool.get('zoomed', frame.shape))
+                if luma is not None:
+                    luma, _ = software_zoom(luma, zoom_factor[0], buffer_pool.get('zoomed_luma', luma.shape))
+
+    # Detection and tracking run on the luma when there is one; the main
+    # stream is only used for display and overlays
+    tracking_frame = frame if luma is None else luma
+    scale = (w / tracking_frame.shape[1], h / tracking_frame.shape[0])
+    tracker.frame_scale = scale
+
+    # Window edits queued since the last frame are applied on this one
+    commands.frame_size = (w, h)
+    if commands.commands:
+        commands.apply(tracker, tracking_input(tracking_frame, buffer_pool), scale)
+
+    updates = []
+    stable_contours = []
+    required = ('tracking', 'overlays', 'display')
+    if hybrid.enabled:
+        # Detection only runs when the hybrid asks for it
+        with scheduler.timed('tracking'):
+            tracker_frame = tracking_input(tracking_frame, buffer_pool)
+            updates = hybrid.step(tracking_frame, tracker_frame, buffer_pool, scale)
+    else:
+        # Detect potential minis. Detection and smoothing are optional: when
+        # the frame is running late the last stable contours are drawn again.
+        if scheduler.due('detection', reserve=('smoothing',) + required):
+            with scheduler.timed('detection'):
+                mini_contours = detector.detect(tracking_frame, buffer_pool, scale)
+                smooth_detector.update(mini_contours)
+
+        # Update and get stable contours
+        if scheduler.due('smoothing', reserve=required):
+            with scheduler.timed('smoothing'):
+                smooth_detector.stable_contours = smooth_detector.get_stable_contours()
+        stable_contours = smooth_detector.stable_contours
+
+        if tracker.tracking:
+            with scheduler.timed('tracking'):
+                tracker_frame = tracking_input(tracking_frame, buffer_pool)
+                updates = tracker.update_all(tracker_frame)
+
+    tracked = []
+    for obj, success, bbox in updates:
+        if success:
+            tracker.set_bbox(obj, scale_bbox(bbox, scale))
+            obj['sensor_bbox'] = bbox_to_sensor(obj['bbox'], scaler_crop, (w, h))
+            tracked.append((obj, get_object_color(obj['label'])))
+
+    if not annotate:
+        buffer_pool.end_frame()
+        scheduler.end_frame()
+        return None
+
+    # Resize the clean frame for display first and draw on the result, so
+    # overlays cost display pixels and stay sharp, and the capture-resolution
+    # frame is never drawn on. Display buffers rotate so the one queued or on
+    # screen is never overwritten while the next frame is produced.
+    with scheduler.timed('display'):
+        if display_size is None:
+            display_frame = buffer_pool.get('annotated', frame.shape)
+            np.copyto(display_frame, frame)
+        else:
+            display_w, display_h = display_size
+            display_frame = cv2.resize(frame, display_size, dst=buffer_pool.get('display', (display_h, display_w, 3), slots=DISPLAY_BUFFER_SLOTS))
+    display_scale = (display_frame.shape[1] / w, display_frame.shape[0] / h)
+    display_bboxes = [scale_bbox(obj['bbox'], display_scale) for obj, _ in tracked]
+
+    if tracked and scheduler.due('particles', reserve=('overlays',)):
+        with scheduler.timed('particles'):
+            create_particle_effects(display_frame, display_bboxes, [color for _, color in tracked])
+
+    with scheduler.timed('overlays'):
+        if overlay is None:
+            for (obj, color), bbox in zip(tracked, display_bboxes):
+                draw_pretty_object(display_frame, obj['label'], bbox, color, particles=False)
+        else:
+            overlay.update(display_frame.shape, [(obj['id'], obj['label'], bbox, color) for (obj, color), bbox in zip(tracked, display_bboxes)])
+            overlay.composite(display_frame)
+
+        # Draw detected minis
+        draw_detected_minis(display_frame, stable_contours, display_scale)
+
+    buffer_pool.end_frame()
+    scheduler.end_frame()
+    return display_frame
+
+def main(source_args=(), sink_args=None, control_address=('127.0.0.1', 8765)):
+    # sink_args selects headless mode: no window, output goes to the sink.
+    # control_address is the (host, port) of the control server, or None
+    source = None
+    server = None
+    pipeline = None
+    tracker = None
+    sink = None
+    headless = sink_args is not None
+    try:
+        source = frame_source_from_args(list(source_args))
+        if headless:
+            sink = output_sink_from_args(list(sink_args))
+
+        tracker = ObjectTracker()
+        smooth_detector = SmoothDetector()
+
+        zoom_factor = [1.0]
+        running = [True]
+        commands = CommandQueue()
+        # On the 640x360 luma the full-frame pass is usually cheaper than the
+        # pyramid, so full refreshes start at level 0 and the menu can raise it
+        detector = IncrementalDetector()
+        hybrid = DetectTrackHybrid(tracker, detector)
+        buffer_pool = FrameBufferPool()
+        profiler = StageProfiler()
+        scheduler = FrameScheduler(profiler=profiler)
+
+        display_size = None if headless else (960, 540)
+        if not headless:
+            cv2.namedWindow("Tracking")
+            editor = LabelEditor(commands)
+            interaction = MouseInteraction(commands, editor, display_size)
+            cv2.setMouseCallback("Tracking", interaction.on_mouse)
+        # Labels and boxes are drawn at display size unless headless, and not
+        # at all when the frames would only be thrown away
+        overlay = OverlayLayer() if headless else OverlayLayer(font_scale=0.4, thickness=1)
+        annotate = not isinstance(sink, NullSink)
+
+        pipeline = FramePipeline(
+            lambda: source.read(zoom_factor[0]),
+            lambda captured: process_frame(captured, tracker, smooth_detector, zoom_factor, commands, buffer_pool, detector, hybrid, scheduler, display_size, overlay, annotate),
+            running, buffer_pool=buffer_pool, scheduler=scheduler, lossless=source.lossless, sink=sink)
+        pipeline.start()
+
+        commands.control = TrackerControl(tracker, zoom_factor, running, source, pipeline, detector, hybrid)
+        if control_address is not None:
+            server = ControlServer(commands, *control_address)
+            if server.start():
+                print(f"Control server on http://{server.host}:{server.port}")
+            else:
+                print(f"Control server unavailable: {server.error}")
+                server = None
+
+        input_thread = threading.Thread(target=handle_input, args=(tracker, commands, running, pipeline, detector, hybrid))
+        input_thread.daemon = True
+        input_thread.start()
+
+        # Headless, the sink is fed from the processing thread and there is
+        # nothing for the main thread to do but wait
+        while headless and running[0]:
+            time.sleep(0.1)
+
+        # The display stage only shows whatever the processing stage finished
+        # last, so capture never waits on detection and display never waits on both.
+        while running[0]:
+            display_frame = pipeline.next_display_frame()
+            if display_frame is not None:
+                if profiler.overlay:
+                    profiler.draw_overlay(display_frame)
+                interaction.draw(display_frame)
+                with scheduler.timed('imshow'):
+                    cv2.imshow("Tracking", display_frame)
+            editor.key(cv2.waitKey(1))
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+    finally:
+        if server:
+            server.stop()
+        if pipeline:
+            pipeline.stop()
+        if tracker:
+            tracker.close()
+        if pipeline and not isinstance(source, PicameraSource):
+            # Replays and load tests mostly run for these numbers
+            print_pipeline_stats(pipeline.stats())
+        if source:
+            source.close()
+        if sink:
+            sink.close()
+        if not headless:
+            cv2.destroyAllWindows()
+        print("Script terminated. Goodbye!")
+        # A replay can end while the menu thread is still blocked on stdin,
+        # which would stall a normal interpreter shutdown
+        sys.stdout.flush()
+        os._exit(0)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "bench-detect":
+        # python mini_test_10.py bench-detect [image ...]
+        benchmark_detection(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == "bench-track":
+        # python mini_test_10.py bench-track
+        benchmark_tracking()
+    elif len(sys.argv) > 1 and sys.argv[1] == "bench-suite":
+        # python mini_test_10.py bench-suite [output.json] [minis] [noise] [motion]
+        args = sys.argv[2:]
+        benchmark_suite(args[0] if args else "benchmark.json",
+                        minis=int(args[1]) if len(args) > 1 else 12,
+                        noise=float(args[2]) if len(args) > 2 else 3.0,
+                        motion=float(args[3]) if len(args) > 3 else 2.0)
+    else:
+        # python mini_test_10.py [camera [device] | replay <video or image dir> [fast] | synthetic [fast]]
+        #                        [headless [none | video <path> | snapshots [directory]]]
+        #                        [control <host:port> | control off]
+        args = sys.argv[1:]
+        control_address = ('127.0.0.1', 8765)
+        if 'control' in args:
+            split = args.index('control')
+            address = args[split + 1] if split + 1 < len(args) else 'off'
+            if address == 'off':
+                control_address = None
+            else:
+                host, _, port = address.rpartition(':')
+                # The API has no authentication, so it only listens beyond
+                # this machine when a host is given explicitly
+                control_address = (host or '127.0.0.1', int(port))
+            del args[split:split + 2]
+        if 'headless' in args:
+            split = args.index('headless')
+            main(args[:split], args[split + 1:], control_address)
+        else:
+            main(args, control_address=control_address)